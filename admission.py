@@ -0,0 +1,151 @@
+import heapq
+import itertools
+import math
+import os
+import time
+
+# Per-chat budgets per command class, as "<burst>/<seconds>": up to <burst>
+# requests at once, refilled at <burst> per <seconds>. "0" disables a class.
+SCRAPE, READ, PREVIEW = "scrape", "read", "preview"
+ADMISSION_BUDGETS = {
+    SCRAPE: os.getenv("ADMISSION_SCRAPE", "3/600"),     # /update: a worker scrape each
+    READ: os.getenv("ADMISSION_READ", "30/60"),         # summaries and lookups: may call GAS
+    PREVIEW: os.getenv("ADMISSION_PREVIEW", "2/300"),   # /testdaily: a full summary build
+}
+ADMISSION_MAX_BUCKETS = int(os.getenv("ADMISSION_MAX_BUCKETS", "10000"))
+
+
+def parse_budget(text):
+    """'3/600' -> (burst 3, 0.005 tokens/s); '0' -> None (unlimited)."""
+    text = str(text).strip()
+    if text in ("", "0"):
+        return None
+    burst, _, seconds = text.partition("/")
+    burst, seconds = float(burst), float(seconds or 1)
+    if burst <= 0 or seconds <= 0:
+        raise ValueError(f"Budget must look like <burst>/<seconds>, got {text!r}")
+    return burst, burst / seconds
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class AdmissionControl:
+    """
+    Non-blocking per-chat token buckets, one per command class. check()
+    either spends a token or says how long until one is available; nothing
+    waits, so a rejected user gets an answer straight away.
+    """
+
+    def __init__(self, budgets=ADMISSION_BUDGETS, max_buckets=ADMISSION_MAX_BUCKETS):
+        self.budgets = {kind: parse_budget(spec) for kind, spec in budgets.items()}
+        self.max_buckets = max_buckets
+        self._buckets = {}   # (kind, chat_id) -> _Bucket
+        self.admitted = 0
+        self.rejected = 0
+
+    def check(self, chat_id, kind, cost=1):
+        """Returns 0 if admitted, else seconds until `cost` tokens are available."""
+        budget = self.budgets.get(kind)
+        if budget is None:
+            return 0
+        burst, rate = budget
+        now = time.monotonic()
+        key = (kind, str(chat_id))
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._prune(now)
+            bucket = self._buckets[key] = _Bucket(burst, now)
+        else:
+            bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+            bucket.updated = now
+        if bucket.tokens >= cost:
+            bucket.tokens -= cost
+            self.admitted += 1
+            return 0
+        self.rejected += 1
+        return (cost - bucket.tokens) / rate
+
+    def _prune(self, now):
+        # A bucket that has refilled is the same as no bucket
+        for key, bucket in list(self._buckets.items()):
+            burst, rate = self.budgets[key[0]]
+            if bucket.tokens + (now - bucket.updated) * rate >= burst:
+                del self._buckets[key]
+
+    def stats(self):
+        return {"buckets": len(self._buckets), "admitted": self.admitted, "rejected": self.rejected}
+
+
+def retry_text(seconds):
+    """Friendly rejection for a request that is over budget."""
+    seconds = math.ceil(seconds)
+    when = f"{seconds}s" if seconds < 120 else f"{math.ceil(seconds / 60)} min"
+    return f"⏳ You're going a bit fast - try again in {when}."
+
+
+class FairQueue:
+    """
+    Weighted fair queue of items tagged with a flow (the chat). An item
+    starts at max(virtual time, the flow's previous finish) and finishes
+    cost / weight later; the smallest finish is served first and virtual
+    time follows the start of whatever was served last. A chat that keeps
+    resubmitting therefore lines up behind chats that haven't had a turn
+    yet instead of crowding them out. Usage history is forgotten whenever
+    the queue drains. push_front() bypasses the ordering (for requeued work).
+    """
+
+    def __init__(self):
+        self._heap = []          # [front, finish, seq, item, start]; item None once removed
+        self._entries = {}       # item -> heap entry
+        self._finish = {}        # flow -> last finish tag
+        self._seq = itertools.count()
+        self.vtime = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def push(self, item, flow, cost=1.0, weight=1.0):
+        start = max(self.vtime, self._finish.get(flow, 0.0))
+        finish = self._finish[flow] = start + cost / weight
+        self._add([1, finish, next(self._seq), item, start])
+
+    def push_front(self, item):
+        self._add([0, self.vtime, next(self._seq), item, self.vtime])
+
+    def _add(self, entry):
+        self._entries[entry[3]] = entry
+        heapq.heappush(self._heap, entry)
+
+    def pop(self):
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            item = entry[3]
+            if item is None:
+                continue
+            del self._entries[item]
+            self.vtime = max(self.vtime, entry[4])
+            if not self._entries:
+                self._heap.clear()
+                self._finish.clear()
+            return item
+        raise IndexError("pop from an empty FairQueue")
+
+    def remove(self, item):
+        entry = self._entries.pop(item, None)
+        if entry is not None:
+            entry[3] = None
+        return entry is not None
+
+    def position(self, item):
+        """1-based position in service order, or 0 if the item isn't queued."""
+        entry = self._entries.get(item)
+        if entry is None:
+            return 0
+        return 1 + sum(1 for e in self._entries.values() if e < entry)
@@ -0,0 +1,154 @@
+"""
+Daily-broadcast benchmark: in-process vs sharded across processes.
+
+Seeds N subscribers with attendance history in a temporary database (so
+no Apps Script calls are needed), then times send_daily_summary() against
+a local fake Bot API for each shard count. Shard pools are started and
+warmed up before timing, as post_init does at boot:
+
+    python bench/broadcast_bench.py --subscribers 5000 --shards 0,2,4
+    python bench/broadcast_bench.py --subscribers 20000 --shards 0,4 --server-procs 4
+
+The fake Bot API runs in --server-procs processes sharing one port, so it
+isn't the bottleneck. Nothing leaves the machine.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+TOKEN = "123456:BENCH"
+FIRST_CHAT_ID = 100000
+SUBJECTS = ["Python", "DBMS", "Operating Systems", "Networks", "Maths_III", "BE Lab", "Compiler Design",
+            "Web Tech", "AI & ML", "Cloud <Elective>"]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _serve_fake(port, latency):
+    from fake_telegram import FakeTelegram
+    FakeTelegram(latency).serve(port=port, reuse_port=True)
+    threading.Event().wait()
+
+
+def seed(bot, chat_ids, subjects):
+    from models import AttendanceData, Row
+    rnd = random.Random(1)
+    for chat_id in chat_ids:
+        rows = []
+        for name in SUBJECTS[:subjects]:
+            conducted = rnd.randint(20, 60)
+            present = rnd.randint(conducted // 2, conducted)
+            rows.append(Row(name, "Theory", conducted, present, present / conducted))
+        bot.history.record(chat_id, AttendanceData(rows))
+        bot.subscribers.set_enabled(chat_id, True)
+
+
+async def run(args, base_url):
+    import bot
+    import metrics
+    from render import HTML
+    from shards import ShardPool
+    from telegram import Bot
+
+    bot.subscribers.open()
+    bot.history.open()
+    chat_ids = [FIRST_CHAT_ID + i for i in range(args.subscribers)]
+    t = time.perf_counter()
+    seed(bot, chat_ids, args.subjects)
+    print(f"seeded {len(chat_ids)} subscribers in {time.perf_counter() - t:.1f}s")
+
+    class App:
+        pass
+
+    sent = metrics.BROADCAST_MESSAGES.labels("sent")
+    results = []
+    async with Bot(TOKEN, base_url=base_url) as tg:
+        App.bot = tg
+        for shards in args.shards:
+            pool = None
+            if shards > 1:
+                t = time.perf_counter()
+                pool = ShardPool(
+                    shards, bot.personalized_summaries, token=TOKEN, base_url=base_url,
+                    bucket=bot.broadcast_bucket, setup=bot.open_shard, prepare=bot.refresh_shard, parse_mode=HTML,
+                ).start()
+                await pool.run(chat_ids[:shards * 10])  # waits for every shard to import bot.py and PTB
+                print(f"shards={shards}: pool ready in {time.perf_counter() - t:.2f}s")
+            bot.broadcast_pool = pool
+            try:
+                before = sent.value
+                t = time.perf_counter()
+                await bot.send_daily_summary(App, chat_ids=chat_ids)
+                wall = time.perf_counter() - t
+            finally:
+                bot.broadcast_pool = None
+                if pool is not None:
+                    await pool.close()
+            count = sent.value - before
+            results.append((shards, count, wall))
+            print(f"shards={shards or 'in-process'}: sent={count:.0f} in {wall:.2f}s = {count / wall:.0f} msg/s")
+
+    print(f"\n{'shards':<12}{'sent':>8}{'wall s':>10}{'msg/s':>10}")
+    for shards, count, wall in results:
+        print(f"{shards or 'in-process':<12}{count:>8.0f}{wall:>10.2f}{count / wall:>10.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscribers", type=int, default=5000)
+    parser.add_argument("--shards", default="0,2,4", help="comma-separated shard counts to compare (0 = in-process)")
+    parser.add_argument("--subjects", type=int, default=8, help="rows per chat (message size)")
+    parser.add_argument("--rate", type=float, default=100000.0, help="global messages/s budget")
+    parser.add_argument("--concurrency", type=int, default=20, help="in-flight sends per process")
+    parser.add_argument("--tg-latency", type=float, default=0.0)
+    parser.add_argument("--server-procs", type=int, default=2, help="fake Bot API processes")
+    args = parser.parse_args()
+    args.shards = [int(s) for s in args.shards.split(",")]
+
+    port = _free_port()
+    ctx = multiprocessing.get_context("spawn")
+    servers = [ctx.Process(target=_serve_fake, args=(port, args.tg_latency), daemon=True)
+               for _ in range(args.server_procs)]
+    for p in servers:
+        p.start()
+    time.sleep(1.0)
+
+    # bot.py (and the shard processes it spawns) read configuration from the environment
+    state = tempfile.mkdtemp(prefix="attendance-broadcast-")
+    os.environ.update({
+        "DB_PATH": os.path.join(state, "bench.db"),
+        "ALERT_FILE": os.path.join(state, "alerts.json"),
+        "PERSISTENCE_FILE": "",
+        "SHEETS_API_URL": "http://127.0.0.1:9/unused",
+        "DEFAULT_ALERT_MODE": "full",
+        "BROADCAST_RATE": str(args.rate),
+        "BROADCAST_CONCURRENCY": str(args.concurrency),
+        "BROADCAST_SHARD_MIN": "0",
+    })
+    import logging
+    logging.disable(logging.INFO)
+
+    try:
+        asyncio.run(run(args, f"http://127.0.0.1:{port}/bot"))
+    finally:
+        for p in servers:
+            p.terminate()
+
+
+if __name__ == "__main__":
+    main()
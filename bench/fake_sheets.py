@@ -0,0 +1,141 @@
+"""
+Local stand-in for the Apps Script (Sheets) endpoint.
+
+Serves deterministic attendance rows per chat_id so bot.py can be run
+offline:
+
+    python bench/fake_sheets.py --port 8081
+    SHEETS_API_URL=http://127.0.0.1:8081/exec python bot.py
+
+Supports GET ?chat_id=..., POST {"action": "register"} and
+POST {"action": "bulk_fetch", "chat_ids": [...]} (disable with --no-bulk
+to exercise the per-chat fallback).
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+SUBJECTS = [
+    ("Python Programming", "Theory"),
+    ("Python Programming Lab", "Lab"),
+    ("Database Management Systems", "Theory"),
+    ("Business Economics", "Theory"),
+    ("Business Economics Lab", "Lab"),
+    ("Operating Systems", "Theory"),
+    ("Discrete Mathematics", "Theory"),
+    ("Computer Networks", "Theory"),
+]
+
+
+def rows_for(chat_id, subjects=len(SUBJECTS)):
+    """Deterministic rows in the GAS layout: subject, type, conducted, present, pct, status, bunk."""
+    rnd = random.Random(str(chat_id))
+    rows = []
+    for i in range(subjects):
+        name, kind = SUBJECTS[i % len(SUBJECTS)]
+        if i >= len(SUBJECTS):
+            name = f"{name} {i // len(SUBJECTS) + 1}"
+        conducted = rnd.randint(20, 60)
+        present = rnd.randint(int(conducted * 0.6), conducted)
+        p = present / conducted
+        status = "Safe" if p >= 0.85 else "Shortage"
+        rows.append([name, kind, conducted, present, p, status, f"Can bunk {max(0, int(present / 0.85 - conducted))} classes"])
+    return rows
+
+
+class FakeSheets:
+    def __init__(self, latency=0.0, error_rate=0.0, subjects=len(SUBJECTS), bulk=True):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.subjects = subjects
+        self.bulk = bulk
+        self.requests = 0
+        self.bulk_requests = 0
+        self.lock = threading.Lock()
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, body, status=200):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _admit(self):
+                with fake.lock:
+                    fake.requests += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fake.error_rate and random.random() < fake.error_rate:
+                    # GAS errors come back as HTML, not JSON
+                    data = b"<html>Service error</html>"
+                    self.send_response(500)
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    return False
+                return True
+
+            def do_GET(self):
+                if not self._admit():
+                    return
+                qs = parse_qs(urlparse(self.path).query)
+                chat_id = qs.get("chat_id", [""])[0]
+                self._reply(rows_for(chat_id, fake.subjects) if chat_id else [])
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                if not self._admit():
+                    return
+                action = payload.get("action")
+                if action == "register":
+                    self._reply({"status": "registered"})
+                elif action == "bulk_fetch" and fake.bulk:
+                    with fake.lock:
+                        fake.bulk_requests += 1
+                    ids = payload.get("chat_ids", [])
+                    self._reply({"status": "ok", "data": {c: rows_for(c, fake.subjects) for c in ids}})
+                else:
+                    self._reply({"status": "error", "message": f"unknown action {action}"})
+
+        return Handler
+
+    def serve(self, host="127.0.0.1", port=0):
+        """Starts the server in a daemon thread; returns (server, url)."""
+        server = ThreadingHTTPServer((host, port), self.handler())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, f"http://{host}:{server.server_address[1]}/exec"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--subjects", type=int, default=len(SUBJECTS), help="rows per chat")
+    parser.add_argument("--no-bulk", action="store_true")
+    args = parser.parse_args()
+
+    fake = FakeSheets(args.latency, args.error_rate, args.subjects, bulk=not args.no_bulk)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), fake.handler())
+    print(f"Fake Sheets endpoint on http://127.0.0.1:{args.port}/exec")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Local stand-in for the Telegram Bot API.
+
+Answers the methods bot.py uses (getMe, sendMessage, editMessageText,
+copyMessage, answerCallbackQuery, answerInlineQuery, ...) with minimal
+valid results, with configurable latency and error rate (errors are
+429 flood-wait replies so the bot's retry path is exercised).
+
+    python bench/fake_telegram.py --port 8082
+    # point an Application at it with base_url="http://127.0.0.1:8082/bot"
+"""
+import argparse
+import collections
+import json
+import random
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BOT_USER = {"id": 1000, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+
+def _params(handler):
+    length = int(handler.headers.get("Content-Length", 0))
+    body = handler.rfile.read(length) if length else b""
+    ctype = handler.headers.get("Content-Type", "")
+    if ctype.startswith("application/json"):
+        return json.loads(body or b"{}")
+    if ctype.startswith("multipart/form-data"):
+        # Only text fields matter here; files (if any) are ignored
+        boundary = ctype.split("boundary=", 1)[1].encode()
+        params = {}
+        for part in body.split(b"--" + boundary):
+            head, _, value = part.partition(b"\r\n\r\n")
+            if b'name="' in head:
+                name = head.split(b'name="', 1)[1].split(b'"', 1)[0].decode()
+                params[name] = value.rstrip(b"\r\n").decode(errors="replace")
+        return params
+    return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+
+
+class _ReusePortServer(ThreadingHTTPServer):
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+class FakeTelegram:
+    def __init__(self, latency=0.0, error_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.calls = collections.Counter()
+        self.errors = 0
+        self.on_send = None   # optional callback(method, params) for simulated peers
+        self._message_id = 0
+        self.lock = threading.Lock()
+
+    def _next_id(self):
+        with self.lock:
+            self._message_id += 1
+            return self._message_id
+
+    def _message(self, params):
+        chat_id = params.get("chat_id", 0)
+        try:
+            chat_id = int(chat_id)
+        except ValueError:
+            pass
+        return {
+            "message_id": self._next_id(),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if isinstance(chat_id, int) and chat_id > 0 else "group"},
+            "from": BOT_USER,
+            "text": params.get("text", params.get("caption", "")),
+        }
+
+    def result(self, method, params):
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText", "sendPhoto"):
+            return self._message(params)
+        if method == "copyMessage":
+            return {"message_id": self._next_id()}
+        # answerCallbackQuery, answerInlineQuery, setWebhook, deleteWebhook, setMyCommands, ...
+        return True
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, body, status=200):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                method = self.path.rstrip("/").rsplit("/", 1)[-1]
+                params = _params(self)
+                with fake.lock:
+                    fake.calls[method] += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fake.error_rate and method != "getMe" and random.random() < fake.error_rate:
+                    with fake.lock:
+                        fake.errors += 1
+                    self._reply({
+                        "ok": False,
+                        "error_code": 429,
+                        "description": f"Too Many Requests: retry after {fake.retry_after}",
+                        "parameters": {"retry_after": fake.retry_after},
+                    }, status=429)
+                    return
+                if fake.on_send:
+                    fake.on_send(method, params)
+                self._reply({"ok": True, "result": fake.result(method, params)})
+
+            do_GET = do_POST
+
+        return Handler
+
+    def serve(self, host="127.0.0.1", port=0, reuse_port=False):
+        """
+        Starts the server in a daemon thread; returns (server, base_url).
+        With reuse_port, several processes can serve one port (SO_REUSEPORT).
+        """
+        server_class = _ReusePortServer if reuse_port else ThreadingHTTPServer
+        server = server_class((host, port), self.handler())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, f"http://{host}:{server.server_address[1]}/bot"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with 429")
+    args = parser.parse_args()
+
+    fake = FakeTelegram(args.latency, args.error_rate)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), fake.handler())
+    print(f"Fake Bot API on http://127.0.0.1:{args.port}/bot")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""
+Offline load test for bot.py.
+
+Runs the real Application (all handlers, cache, job tracker, broadcaster)
+against local stand-ins for the Telegram Bot API and the Apps Script
+endpoint, simulates N users and an in-process worker bot, and reports
+latency percentiles, updates/s and memory:
+
+    python bench/loadtest.py --users 200 --actions 20
+    python bench/loadtest.py --users 500 --sheets-latency 0.3 --broadcast
+    python bench/loadtest.py --workers 4 --update-ratio 0.3 --kill-worker-after 2
+
+Nothing leaves the machine; state goes to a temporary directory.
+"""
+import argparse
+import asyncio
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+from fake_sheets import FakeSheets  # noqa: E402
+from fake_telegram import BOT_USER, FakeTelegram  # noqa: E402
+
+GROUP_ID = -1001234567890
+WORKER_USER = {"id": 2000, "is_bot": True, "first_name": "Worker"}
+FIRST_USER_ID = 100000
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class SimWorker:
+    """A pooled worker bot: announces itself, heartbeats, and only serves requests addressed to it."""
+
+    def __init__(self, worker_id, capacity):
+        self.worker_id = worker_id
+        self.capacity = capacity
+        self.handled = 0
+        self.silent = False
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.updates = 0
+        self._update_id = 0
+        self.captcha_events = defaultdict(asyncio.Event)
+        self.done_events = defaultdict(asyncio.Event)
+        self.reassigned_events = defaultdict(asyncio.Event)
+        self.rejected_events = defaultdict(asyncio.Event)
+        self.rejected = 0
+        self.workers = {f"w{i + 1}": SimWorker(f"w{i + 1}", args.worker_capacity) for i in range(args.workers)}
+        self.job_workers = {}   # job_id -> SimWorker holding it
+
+    # ---------- synthetic updates ----------
+
+    def _next_id(self):
+        self._update_id += 1
+        return self._update_id
+
+    def _user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"User{uid}"}
+
+    def message(self, uid, text):
+        from telegram import Update
+        msg = {
+            "message_id": self._next_id(),
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": self._user(uid),
+            "text": text,
+        }
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return Update.de_json({"update_id": self._next_id(), "message": msg}, self.app.bot)
+
+    def callback(self, uid, data):
+        from telegram import Update
+        return Update.de_json({
+            "update_id": self._next_id(),
+            "callback_query": {
+                "id": str(self._next_id()),
+                "from": self._user(uid),
+                "chat_instance": str(uid),
+                "data": data,
+                "message": {
+                    "message_id": self._next_id(),
+                    "date": int(time.time()),
+                    "chat": {"id": uid, "type": "private"},
+                    "from": BOT_USER,
+                    "text": "menu",
+                },
+            },
+        }, self.app.bot)
+
+    def inline(self, uid, query):
+        from telegram import Update
+        return Update.de_json({
+            "update_id": self._next_id(),
+            "inline_query": {"id": str(self._next_id()), "from": self._user(uid), "query": query, "offset": ""},
+        }, self.app.bot)
+
+    def worker_message(self, text, photo=False):
+        from telegram import Update
+        msg = {
+            "message_id": self._next_id(),
+            "date": int(time.time()),
+            "chat": {"id": GROUP_ID, "type": "supergroup", "title": "workers"},
+            "from": WORKER_USER,
+        }
+        if photo:
+            msg["photo"] = [{"file_id": "captcha", "file_unique_id": "captcha", "width": 120, "height": 40}]
+            msg["caption"] = text
+        else:
+            msg["text"] = text
+        return Update.de_json({"update_id": self._next_id(), "message": msg}, self.app.bot)
+
+    async def process(self, action, update):
+        t = time.perf_counter()
+        try:
+            await self.app.update_processor.process_update(update, self.app.process_update(update))
+        except Exception:
+            self.errors[action] += 1
+        self.latencies[action].append(time.perf_counter() - t)
+        self.updates += 1
+
+    # ---------- simulated worker bot ----------
+
+    def on_bot_call(self, method, params):
+        """Called from the fake Bot API thread for every bot call."""
+        self.loop.call_soon_threadsafe(self._observe, method, dict(params))
+
+    def _observe(self, method, params):
+        chat_id = str(params.get("chat_id", ""))
+        text = params.get("text", "")
+        if chat_id == str(GROUP_ID) and method == "sendMessage":
+            asyncio.ensure_future(self._worker(text))
+        elif method == "copyMessage":
+            self.captcha_events[chat_id].set()
+        elif method == "sendMessage" and "Summary" in text:
+            self.done_events[chat_id].set()
+        elif text.startswith("⏳ You're going a bit fast"):
+            self.rejected += 1
+            self.rejected_events[chat_id].set()
+        elif method == "sendMessage" and text.startswith("🔁"):
+            # The job went back to the queue; a fresh CAPTCHA will follow
+            self.captcha_events[chat_id].clear()
+            self.reassigned_events[chat_id].set()
+
+    async def _worker(self, text):
+        parts = text.split()
+        kind = parts[0]
+        worker = None
+        if self.workers:
+            if kind == "REQ_SCRAPE":
+                worker = self.workers.get(parts[-1])
+                self.job_workers[parts[2]] = worker
+                parts = parts[:-1]
+            else:
+                worker = self.job_workers.get(parts[2])
+            if worker is None or worker.silent:
+                return
+        rest = " ".join(parts[1:])
+        await asyncio.sleep(self.args.worker_delay)
+        if worker is not None and worker.silent:
+            return
+        if kind == "REQ_SCRAPE":
+            await self.process("worker", self.worker_message(f"CAPTCHA_REQ {rest}", photo=True))
+        elif kind == "CAPTCHA_SOL":
+            # drop the solution text; SUCCESS carries only job id and chat id
+            await self.process("worker", self.worker_message("SUCCESS " + " ".join(parts[1:-1])))
+            if worker is not None:
+                worker.handled += 1
+
+    async def heartbeats(self, worker):
+        await self.process("worker control", self.worker_message(f"HELLO v1 {worker.worker_id} {worker.capacity}"))
+        while not worker.silent:
+            await asyncio.sleep(self.args.heartbeat_interval)
+            if not worker.silent:
+                await self.process("worker control", self.worker_message(f"HEARTBEAT v1 {worker.worker_id}"))
+
+    async def chaos(self, bot):
+        """Silences the first worker mid-run and sweeps often enough to notice."""
+        if self.args.kill_worker_after is not None and self.workers:
+            await asyncio.sleep(self.args.kill_worker_after)
+            next(iter(self.workers.values())).silent = True
+        while True:
+            await asyncio.sleep(self.args.heartbeat_interval)
+            await bot.scrape_jobs.sweep()
+
+    # ---------- user sessions ----------
+
+    async def update_flow(self, uid):
+        """Whole /update round-trip: request, CAPTCHA, answer, summary."""
+        key = str(uid)
+        self.captcha_events[key].clear()
+        self.done_events[key].clear()
+        self.rejected_events[key].clear()
+        t = time.perf_counter()
+        await self.process("/update", self.message(uid, "/update"))
+        await asyncio.sleep(0)  # let the reply's observer run
+        if self.rejected_events[key].is_set():
+            return
+        try:
+            while True:
+                self.reassigned_events[key].clear()
+                await asyncio.wait_for(self.captcha_events[key].wait(), self.args.flow_timeout)
+                await self.process("captcha reply", self.message(uid, "x7k2p"))
+                done = asyncio.ensure_future(self.done_events[key].wait())
+                moved = asyncio.ensure_future(self.reassigned_events[key].wait())
+                finished, _ = await asyncio.wait((done, moved), timeout=self.args.flow_timeout,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                done.cancel()
+                moved.cancel()
+                if not finished:
+                    raise asyncio.TimeoutError
+                if self.done_events[key].is_set():
+                    break
+            self.latencies["update flow (e2e)"].append(time.perf_counter() - t)
+        except asyncio.TimeoutError:
+            self.errors["update flow (e2e)"] += 1
+
+    async def session(self, uid):
+        rnd = random.Random(uid)
+        for _ in range(self.args.actions):
+            if self.args.inline_ratio and rnd.random() < self.args.inline_ratio:
+                query = rnd.choice(["", "python", "dbms", "lab", "pyhton"])
+                await self.process("inline", self.inline(uid, query))
+                await asyncio.sleep(rnd.random() * self.args.think_time)
+                continue
+            roll = rnd.random()
+            if roll < self.args.update_ratio:
+                await self.update_flow(uid)
+            elif roll < 0.35:
+                await self.process("/summary", self.message(uid, "/summary"))
+            elif roll < 0.55:
+                subject = rnd.choice(["python", "dbms", "BE lab", "pyhton", "os", "networks"])
+                await self.process("/attendance", self.message(uid, f"/attendance {subject}"))
+            elif roll < 0.65:
+                await self.process("/bunk", self.message(uid, "/bunk math"))
+            elif roll < 0.85:
+                await self.process("menu", self.callback(uid, "main_menu"))
+                await self.process("menu:summary", self.callback(uid, "cmd_summary"))
+            else:
+                await self.process("menu:below85", self.callback(uid, "cmd_below85"))
+            await asyncio.sleep(rnd.random() * self.args.think_time)
+
+    # ---------- run ----------
+
+    async def run(self):
+        import bot
+
+        self.loop = asyncio.get_running_loop()
+        self.app = bot.build_application(token="123456:BENCH", base_url=self.tg_url)
+        await self.app.initialize()
+        await bot.post_init(self.app)
+        await self.app.start()
+
+        background = [asyncio.ensure_future(self.heartbeats(w)) for w in self.workers.values()]
+        background.append(asyncio.ensure_future(self.chaos(bot)))
+        await asyncio.sleep(0)
+
+        users = [FIRST_USER_ID + i for i in range(self.args.users)]
+        started = time.perf_counter()
+        await asyncio.gather(*(self.session(uid) for uid in users))
+        self.wall = time.perf_counter() - started
+        for task in background:
+            task.cancel()
+        self.job_stats = bot.scrape_jobs.stats()
+
+        self.broadcast = None
+        if self.args.broadcast:
+            for uid in users:
+                bot.subscribers.set_enabled(uid, True)
+            t = time.perf_counter()
+            await bot.send_daily_summary(self.app)
+            self.broadcast = time.perf_counter() - t
+
+        self.cache_stats = bot.attendance_cache.stats()
+        await self.app.stop()
+        await bot.post_shutdown(self.app)
+        await self.app.shutdown()
+
+    def report(self):
+        a = self.args
+        print(f"\nusers={a.users} actions/user={a.actions} "
+              f"tg_latency={a.tg_latency}s sheets_latency={a.sheets_latency}s")
+        print(f"{'action':<20}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for action in sorted(self.latencies):
+            values = self.latencies[action]
+            print(f"{action:<20}{len(values):>8}{self.errors[action]:>8}"
+                  f"{percentile(values, .50) * 1000:>10.1f}"
+                  f"{percentile(values, .95) * 1000:>10.1f}"
+                  f"{percentile(values, .99) * 1000:>10.1f}")
+        print(f"\nupdates={self.updates} wall={self.wall:.2f}s updates/s={self.updates / self.wall:.1f}")
+        if self.broadcast is not None:
+            print(f"daily broadcast to {a.users} users: {self.broadcast:.2f}s")
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"max RSS={rss:.1f} MB")
+        print(f"cache={self.cache_stats}")
+        print(f"jobs={self.job_stats}")
+        print(f"rejected by admission={self.rejected}")
+        if self.workers:
+            print("workers=" + " ".join(
+                f"{w.worker_id}:{w.handled}{' (silenced)' if w.silent else ''}" for w in self.workers.values()
+            ))
+        print(f"sheets requests={self.sheets.requests} (bulk={self.sheets.bulk_requests})")
+        print(f"bot api calls={dict(self.telegram.calls)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--actions", type=int, default=10, help="actions per user")
+    parser.add_argument("--think-time", type=float, default=0.05, help="max pause between actions (s)")
+    parser.add_argument("--update-ratio", type=float, default=0.05, help="share of actions that run /update")
+    parser.add_argument("--worker-delay", type=float, default=0.05, help="simulated worker step time (s)")
+    parser.add_argument("--flow-timeout", type=float, default=30.0)
+    parser.add_argument("--tg-latency", type=float, default=0.0)
+    parser.add_argument("--tg-error-rate", type=float, default=0.0)
+    parser.add_argument("--sheets-latency", type=float, default=0.05)
+    parser.add_argument("--sheets-error-rate", type=float, default=0.0)
+    parser.add_argument("--inline-ratio", type=float, default=0.0, help="share of actions that are inline queries")
+    parser.add_argument("--subjects", type=int, default=8, help="rows per chat (payload size)")
+    parser.add_argument("--broadcast", action="store_true", help="also time a full daily broadcast")
+    parser.add_argument("--broadcast-rate", type=float, default=30.0)
+    parser.add_argument("--max-inflight-scrapes", type=int, default=4)
+    parser.add_argument("--admission", action="store_true",
+                        help="keep the per-chat command budgets (off by default so every action runs)")
+    parser.add_argument("--workers", type=int, default=0, help="pooled workers (0 = one legacy worker)")
+    parser.add_argument("--worker-capacity", type=int, default=1, help="concurrent scrapes per pooled worker")
+    parser.add_argument("--heartbeat-interval", type=float, default=0.5)
+    parser.add_argument("--kill-worker-after", type=float, default=None,
+                        help="silence the first pooled worker after this many seconds")
+    args = parser.parse_args()
+
+    test = LoadTest(args)
+    test.sheets = FakeSheets(args.sheets_latency, args.sheets_error_rate, args.subjects)
+    _, sheets_url = test.sheets.serve()
+    test.telegram = FakeTelegram(args.tg_latency, args.tg_error_rate)
+    test.telegram.on_send = test.on_bot_call
+    _, test.tg_url = test.telegram.serve()
+
+    # bot.py reads its configuration at import time
+    state = tempfile.mkdtemp(prefix="attendance-bench-")
+    os.environ.update({
+        "SHEETS_API_URL": sheets_url,
+        "COMMUNICATION_GROUP_ID": str(GROUP_ID),
+        "DB_PATH": os.path.join(state, "bench.db"),
+        "ALERT_FILE": os.path.join(state, "alerts.json"),
+        "PERSISTENCE_FILE": os.path.join(state, "state.pickle"),
+        "BROADCAST_RATE": str(args.broadcast_rate),
+        "MAX_INFLIGHT_SCRAPES": str(args.max_inflight_scrapes),
+        "WORKER_HEARTBEAT_TIMEOUT": str(args.heartbeat_interval * 3),
+    })
+    if not args.admission:
+        os.environ.update({"ADMISSION_SCRAPE": "0", "ADMISSION_READ": "0", "ADMISSION_PREVIEW": "0"})
+    import logging
+    logging.disable(logging.INFO)
+
+    asyncio.run(test.run())
+    test.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,33 @@
-import httpx
-import json
+import time
+
+BOOT = time.monotonic()  # time-to-ready is measured from here, before the heavy imports
+
+import functools
+import hashlib
+import itertools
 import os
 import logging
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, filters, ConversationHandler
-from apscheduler.schedulers.background import BackgroundScheduler
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InlineQueryResultsButton, InputTextMessageContent
+from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, filters, ConversationHandler, PicklePersistence, InlineQueryHandler
 import io
 import asyncio
 
+from admission import PREVIEW, READ, SCRAPE, AdmissionControl, retry_text
+from broadcast import BROADCAST_RATE, Broadcaster, TokenBucket
+from cache import CACHE_TTL, AttendanceCache
+from calculator import DEFAULT_THRESHOLD, assess, format_threshold, parse_threshold, plan, safe_threshold, what_if
+import metrics
+from history import (TREND_WINDOW, HistoryStore, change_since, decode, encode_keyframe, entries_of, project,
+                     subject_series, term_end)
+from jobs import CAPTCHA_REQ, FAIL, FAILED, QUEUED, SUCCESS, JobTracker, parse_control, parse_message
+from models import parse_rows
+from render import HTML, RenderCache, Template, escape_html, split_message
+from scheduler import SCHEDULER_TICK, DeliveryPlanner, parse_time, resolve_tz
+from serving import ChatOrderedUpdateProcessor, InstrumentedRequest, run, update_key
+from shards import BROADCAST_SHARD_MIN, BROADCAST_SHARDS, ShardPool
+from sheets import SheetsClient, SheetsError, SheetsPayloadError, SheetsQuota, SheetsTimeout, SheetsUnavailable
+from store import DB_PATH, CaptchaWaits, SubscriberStore
+
 # Enable logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -18,147 +38,464 @@ logging.basicConfig(
 WAITING_USERNAME, WAITING_PASSWORD = range(2)
 
 BOT_TOKEN = "8329574176:AAHVRhNgGjT5Z1ckbivE5r8e2H02e5TO6NA"
-SHEETS_API_URL = "https://script.google.com/macros/s/AKfycbyrXm2wWTwWkgCZdnLvvEW8rLluiS4JIB2NWJjpHr6-V2x9UCxj-I4tz6Buld4VaxMe/exec"
+SHEETS_API_URL = os.getenv("SHEETS_API_URL", "https://script.google.com/macros/s/AKfycbyrXm2wWTwWkgCZdnLvvEW8rLluiS4JIB2NWJjpHr6-V2x9UCxj-I4tz6Buld4VaxMe/exec")
 AUTH_TOKEN = "Rmodi182"
 COMMUNICATION_GROUP_ID = os.getenv("COMMUNICATION_GROUP_ID") # Group where both bots communicate
+ADMIN_CHAT_IDS = {c.strip() for c in os.getenv("ADMIN_CHAT_IDS", "").split(",") if c.strip()}  # may use /stats
+ALERT_FILE = os.getenv("ALERT_FILE", "alerts.json")  # legacy JSON store, migrated into DB_PATH
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "50"))  # chat_ids per bulk Sheets request
+BULK_FALLBACK_CONCURRENCY = int(os.getenv("BULK_FALLBACK_CONCURRENCY", "5"))
+BULK_DEADLINE = float(os.getenv("BULK_DEADLINE", "30"))  # seconds per bulk Sheets request, retries included
+# Daily alert modes: "full" always sends the summary, "changes" only when the
+# data changed since the last one, "diff" sends just what changed
+ALERT_MODES = ("full", "changes", "diff")
+# bot_data, user_data and /login conversation state survive restarts here ("" disables)
+PERSISTENCE_FILE = os.getenv("PERSISTENCE_FILE", "bot_state.pickle")
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "60"))  # seconds between flushes
+DEFAULT_ALERT_MODE = os.getenv("DEFAULT_ALERT_MODE", "changes")
+
+# Shared, pooled client for all Apps Script traffic (opened in post_init)
+sheets = SheetsClient(SHEETS_API_URL)
+
+# Per-chat attendance cache; invalidated when the worker reports SUCCESS
+attendance_cache = AttendanceCache()
+
+# Worker scrape jobs (callbacks bound in post_init)
+scrape_jobs = JobTracker()
+
+# Alert subscribers (SQLite, opened in post_init)
+subscribers = SubscriberStore(DB_PATH, legacy_json=ALERT_FILE)
+
+# Chats expected to answer a CAPTCHA (persistent, expiring)
+captcha_waits = CaptchaWaits(DB_PATH)
+
+# Attendance snapshots after every successful scrape (SQLite, opened in post_init)
+history = HistoryStore(DB_PATH)
+
+# Per-chat budgets for expensive commands (admins are exempt)
+admission = AdmissionControl()
+
+# Rendered message bodies per (chat, data version, view)
+rendered = RenderCache()
+
+# /metrics HTTP server, when METRICS_PORT is set (started in post_init)
+metrics_server = None
+
+# Spreads each subscriber's daily summary around their own delivery time
+planner = DeliveryPlanner()
+
+# Global send budget shared by every broadcast, so overlapping dispatch runs
+# stay under Telegram's limit together and a flood wait pauses all of them
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+
+# Broadcast processes when BROADCAST_SHARDS > 1 (started in post_init)
+broadcast_pool = None
+
+# Flipped off once the Sheets endpoint answers a bulk request with something else
+bulk_supported = True
 
 
 
 
 # ---------- HELPERS ----------
 
-async def fetch_data(chat_id=None):
-    url = SHEETS_API_URL
-    if chat_id:
-        url += f"?chat_id={chat_id}"
-        
-    async with httpx.AsyncClient(follow_redirects=True) as client:
-        r = await client.get(url, timeout=20.0)
-        # GAS returns empty or error JSON sometimes
-        try:
-            return r.json()
-        except:
-             return []
+async def fetch_data(chat_id=None, deadline=None):
+    """Raw sheet rows; raises a SheetsError subclass instead of guessing on failure."""
+    params = {"chat_id": chat_id} if chat_id else None
+    return await sheets.get_json(params=params, op="fetch", deadline=deadline)
 
-def pct(p):
-    return f"{p*100:.1f}%"
 
+async def load_data(chat_id):
+    """Fetches and parses one chat's sheet into AttendanceData."""
+    return parse_rows(await fetch_data(chat_id), chat_id)
 
-def load_alerts():
-    if not os.path.exists(ALERT_FILE):
-        return {}
-    with open(ALERT_FILE, "r") as f:
-        return json.load(f)
+
+async def get_data(chat_id):
+    """
+    Cached, single-flight load_data(chat_id) for read commands.
+    If Sheets fails and an older copy is still cached (however old), that
+    copy is returned instead; stale_note() tells the user how old it is.
+    """
+    chat_id = str(chat_id)
+    try:
+        return await attendance_cache.get(chat_id, load_data)
+    except SheetsError as e:
+        cached = attendance_cache.peek(chat_id)
+        if cached is None:
+            raise
+        logging.warning(f"Serving cached data for {chat_id}: {e}")
+        return cached
+
+
+def stale_note(data):
+    """Prefix for replies built from data older than the cache TTL, else ''."""
+    age = time.time() - data.fetched_at
+    if age < CACHE_TTL:
+        return ""
+    if age < 3600:
+        ago = f"{age // 60:.0f} min"
+    elif age < 86400:
+        ago = f"{age / 3600:.1f} h"
+    else:
+        ago = f"{age / 86400:.1f} days"
+    return f"🕒 Showing saved data from {ago} ago\n\n"
 
 
+def fetch_error_text(e):
+    """User-facing message for a failed attendance fetch."""
+    if isinstance(e, SheetsTimeout):
+        return "⚠️ The attendance sheet is responding slowly. Please try again in a minute."
+    if isinstance(e, SheetsQuota):
+        return "⚠️ The attendance sheet is over its usage quota. Please try again in a few minutes."
+    if isinstance(e, SheetsUnavailable):
+        return "⚠️ The attendance sheet is unavailable right now. Please try again shortly."
+    if isinstance(e, SheetsPayloadError):
+        return "⚠️ The attendance sheet sent back something unreadable. Please try /update."
+    return f"⚠️ Error fetching data: {e}"
 
-def save_alerts(data):
-    with open(ALERT_FILE, "w") as f:
-        json.dump(data, f)
 
+async def fetch_many(chat_ids):
+    """Per-chat fetches with bounded concurrency. Returns {chat_id: AttendanceData}, skipping failures."""
+    sem = asyncio.Semaphore(BULK_FALLBACK_CONCURRENCY)
 
-def get_initials(name):
-    # "Business Economics" -> "BE"
-    parts = name.split()
-    return "".join(p[0].upper() for p in parts if p)
+    async def one(chat_id):
+        async with sem:
+            try:
+                return chat_id, await get_data(chat_id)
+            except Exception as e:
+                logging.error(f"Failed to fetch data for {chat_id}: {e}")
+                return chat_id, None
 
+    results = await asyncio.gather(*(one(c) for c in chat_ids))
+    return {chat_id: data for chat_id, data in results if data is not None}
 
-def match_subject(query, rows):
+
+def bulk_unsupported(body):
+    """True for the endpoint's explicit "unknown action" answer (a script without bulk_fetch)."""
+    if not isinstance(body, dict) or body.get("status") != "error":
+        return False
+    message = str(body.get("message", "")).lower()
+    return "unknown action" in message or "unsupported action" in message
+
+
+async def fetch_bulk(chat_ids):
     """
-    Matches query against rows (subject names) using:
-    1. Case-insensitive substring match
-    2. Case-insensitive abbreviation match (initials)
-    Returns list of matching rows.
+    Fetches rows for many chats in one Apps Script round-trip.
+    The endpoint answers {"action": "bulk_fetch", "chat_ids": [...]} with
+    {"status": "ok", "data": {chat_id: rows}}. Chats missing from the answer,
+    and whole batches when the call fails, go through fetch_many(); bulk is
+    only given up on when the endpoint says it doesn't know the action.
+    Returns {chat_id: AttendanceData}.
     """
-    query = query.strip().upper()
-    matches = []
-    
-    for r in rows:
-        subject = r[0]
-        subject_upper = subject.upper()
-        initials = get_initials(subject)
-        
-        # 1. Substring match (using original query logic)
-        # We use 'in' for substring
-        if query in subject_upper:
-            matches.append(r)
-            continue
-            
-        # 2. Initials match
-        # Exact match of initials "BE" == "BE"
-        if query == initials:
-            matches.append(r)
-            
-    return matches
+    global bulk_supported
+    chat_ids = [str(c) for c in chat_ids]
+    if bulk_supported:
+        payload = {"action": "bulk_fetch", "chat_ids": chat_ids, "auth_token": AUTH_TOKEN}
+        try:
+            body = await sheets.post_json(payload, op="bulk", deadline=BULK_DEADLINE, idempotent=True)
+            if isinstance(body, dict) and isinstance(body.get("data"), dict):
+                data = {str(k): parse_rows(v, k) for k, v in body["data"].items()}
+                for chat_id, parsed in data.items():
+                    attendance_cache.put(chat_id, parsed)
+                missing = [c for c in chat_ids if c not in data]
+                if missing:
+                    logging.warning(f"Bulk fetch left out {len(missing)} chats; fetching them one by one")
+                    data.update(await fetch_many(missing))
+                return data
+            if bulk_unsupported(body):
+                logging.warning("Sheets endpoint has no bulk_fetch; using per-chat fetches")
+                bulk_supported = False
+            else:
+                logging.error(f"Bulk fetch failed, using per-chat fetches: {str(body)[:200]}")
+        except Exception as e:
+            logging.error(f"Bulk fetch failed, using per-chat fetches: {e}")
+    return await fetch_many(chat_ids)
 
+def pct(p):
+    return f"{p*100:.1f}%"
 
-# ---------- DAILY SUMMARY ENGINE ----------
 
-async def send_daily_summary(app, target_chat_id=None):
+def threshold_for(chat_id):
+    """The chat's attendance target (/threshold), else ATTENDANCE_THRESHOLD."""
+    sub = subscribers.get(chat_id)
+    if sub is None or sub.threshold is None:
+        return DEFAULT_THRESHOLD
+    # stored as REAL; snap back to the decimal the user typed
+    return parse_threshold(f"{sub.threshold:.6g}")
+
+
+# ---------- TEMPLATES ----------
+# Message bodies are HTML; render.Template escapes every field (subject
+# names come straight from the sheet), and view_text() caches the result.
+
+T_SUMMARY = Template("📊 <b>Attendance Summary</b>\n\n")
+T_SUBJECT_PCT = Template("{r.subject} ({r.type}): {r.pct:.1%}\n")
+T_BELOW = Template("⚠️ <b>Below {target}</b>\n\n")
+T_ALL_ABOVE = Template("✅ All subjects above {target}")
+T_ATTENDANCE = Template("{r.subject} ({r.type})\nConducted: {r.conducted}\nPresent: {r.present}\nAttendance: {r.pct:.1%}\n")
+T_STATUS = Template("Status: {status}\n\n")
+T_BUNK = Template("{r.subject} ({r.type}): {r.present}/{r.conducted} = {pct:.1%}\n{plan}\n\n")
+T_DAILY = Template("📅 <b>Daily Attendance Summary</b>\n\n")
+T_DAILY_BELOW = Template("⚠️ <b>Below {target}</b>\n")
+T_DAILY_ALL_ABOVE = Template("✅ All subjects above {target}\n")
+T_DAILY_SAFE = Template("\n🟢 <b>Safe (≥{target})</b>\n")
+T_DAILY_PRIORITY = Template("\n🎯 <b>Priority Today</b>\n")
+T_BULLET_PCT = Template("• {r.subject} ({r.pct:.1%})\n")
+T_DIFF = Template("📅 <b>Attendance changes since your last summary</b>\n\n")
+T_DIFF_NEW = Template("• {subject}: new, {now:.1%}")
+T_DIFF_HELD = Template("• {subject} held at {now:.1%}")
+T_DIFF_MOVED = Template("• {subject} {verb} {was:.1%} → {now:.1%}")
+T_DIFF_BELOW = Template(" ⚠️ below {target}")
+T_DIFF_ABOVE = Template(" ✅ back above {target}")
+T_DIFF_UNCHANGED = Template("\n{count} other subject(s) unchanged. /summary shows everything.")
+
+
+def view_text(chat_id, data, view, build):
     """
-    Sends summary.
-    If target_chat_id is provided, sends ONLY to that chat (for testing).
-    Otherwise, sends to all subscribed chats (scheduled job).
+    stale_note(data) + the body build() renders for `view` of chat_id's data,
+    reused until the data changes. `view` must include every other input
+    (threshold, subjects, ...); the stale note is added fresh since it ages.
     """
-    try:
-        rows = await fetch_data()
-    except Exception as e:
-        logging.error(f"Failed to fetch data: {e}")
-        if target_chat_id:
-            await app.bot.send_message(target_chat_id, f"⚠️ Failed to fetch data: {e}")
-        return
+    return stale_note(data) + rendered.get(chat_id, data.fetched_at, view, build)
 
-    alerts = load_alerts()
-    # If this is a scheduled run, and no alerts are set, just return
-    if target_chat_id is None and not alerts:
-        return
 
-    below85 = [r for r in rows if r[4] < 0.85]
-    safe = [r for r in rows if r[4] >= 0.90]
+async def send_chunks(send, text, parse_mode=HTML, **kwargs):
+    """Sends `text` through `send(chunk, ...)` in as many messages as Telegram's size limit needs."""
+    for chunk in split_message(text):
+        await send(chunk, parse_mode=parse_mode, **kwargs)
+
+
+async def edit_chunks(query, text, parse_mode=HTML):
+    """Edits the callback's message to the first chunk of `text`; any rest follows as new messages."""
+    first, *rest = split_message(text)
+    await query.edit_message_text(first, parse_mode=parse_mode)
+    for chunk in rest:
+        await query.message.reply_text(chunk, parse_mode=parse_mode)
+
 
-    msg = "📅 *Daily Attendance Summary*\n\n"
+# ---------- DAILY SUMMARY ENGINE ----------
+
+def build_daily_summary(rows, threshold=DEFAULT_THRESHOLD):
+    safe_at = safe_threshold(threshold)
+    below = [r for r in rows if r.pct < threshold]
+    safe = [r for r in rows if r.pct >= safe_at]
 
-    if below85:
-        msg += "⚠️ *Below 85%*\n"
-        for r in below85:
-            msg += f"• {r[0]} ({pct(r[4])})\n"
+    parts = [T_DAILY()]
+
+    if below:
+        parts.append(T_DAILY_BELOW(target=format_threshold(threshold)))
+        parts.extend(T_BULLET_PCT(r=r) for r in below)
     else:
-        msg += "✅ All subjects above 85%\n"
+        parts.append(T_DAILY_ALL_ABOVE(target=format_threshold(threshold)))
 
-    msg += "\n🟢 *Safe (≥90%)*\n"
+    parts.append(T_DAILY_SAFE(target=format_threshold(safe_at)))
     if safe:
-        for r in safe:
-            msg += f"• {r[0]} ({pct(r[4])})\n"
+        parts.extend(T_BULLET_PCT(r=r) for r in safe)
+    else:
+        parts.append("• None\n")
+
+    parts.append(T_DAILY_PRIORITY())
+    parts.extend(T_BULLET_PCT(r=r) for r in sorted(rows, key=lambda x: x.pct)[:3])
+    return "".join(parts)
+
+
+def local_data(chat_id):
+    """Newest attendance already on hand (history snapshot or cache), or None."""
+    held = [d for d in (history.latest(chat_id), attendance_cache.peek(str(chat_id))) if d is not None and d.rows]
+    return max(held, key=lambda d: d.fetched_at, default=None)
+
+
+def build_daily_diff(previous, rows, threshold=DEFAULT_THRESHOLD):
+    """Compact alert listing only subjects whose counts moved since `previous` (snapshot entries)."""
+    before = {(s, k): (c, p) for s, k, c, p in previous}
+    target = format_threshold(threshold)
+    lines = []
+    for r in rows:
+        old = before.get((r.subject, r.type))
+        if old is None:
+            lines.append(T_DIFF_NEW(subject=r.subject, now=r.pct))
+            continue
+        if old == (r.conducted, r.present):
+            continue
+        was = old[1] / old[0] if old[0] else 0.0
+        now = r.present / r.conducted if r.conducted else r.pct
+        if now == was:
+            line = T_DIFF_HELD(subject=r.subject, now=now)
+        else:
+            line = T_DIFF_MOVED(subject=r.subject, verb="rose" if now > was else "dropped", was=was, now=now)
+        if was >= threshold > now:
+            line += T_DIFF_BELOW(target=target)
+        elif now >= threshold > was:
+            line += T_DIFF_ABOVE(target=target)
+        lines.append(line)
+
+    msg = T_DIFF() + "\n".join(lines) + "\n"
+    unchanged = len(rows) - len(lines)
+    if unchanged:
+        msg += T_DIFF_UNCHANGED(count=unchanged)
+    return msg
+
+
+def daily_message(chat_id, data):
+    """
+    Returns (text, content_hash, snapshot) for chat_id's daily alert.
+    text is None when the chat's alert mode says an unchanged summary is skipped.
+    """
+    snapshot = encode_keyframe(entries_of(data.rows))
+    content_hash = hashlib.blake2b(snapshot, digest_size=8).hexdigest()
+    sub = subscribers.get(chat_id)
+    mode = (sub.alert_mode if sub is not None else None) or DEFAULT_ALERT_MODE
+    threshold = threshold_for(chat_id)
+    if sub is not None and mode != "full" and sub.sent_hash == content_hash:
+        return None, content_hash, snapshot
+    if sub is not None and mode == "diff" and sub.sent_snapshot:
+        view = ("diff", threshold, sub.sent_hash)
+        build = lambda: build_daily_diff(decode(sub.sent_snapshot), data.rows, threshold)
     else:
-        msg += "• None\n"
+        view = ("daily", threshold)
+        build = lambda: build_daily_summary(data.rows, threshold)
+    return view_text(chat_id, data, view, build), content_hash, snapshot
 
-    msg += "\n🎯 *Priority Today*\n"
-    for r in sorted(rows, key=lambda x: x[4])[:3]:
-        msg += f"• {r[0]} ({pct(r[4])})\n"
 
+async def personalized_summaries(chat_ids, pending=None, skipped=None):
+    """
+    Yields (chat_id, [message chunks]) for every chat that has data and something to say.
+    Summaries come from local_data(); only chats without any are fetched,
+    BULK_BATCH_SIZE at a time and one batch ahead of the sender, so GAS
+    round-trips scale with batches of new users rather than all users.
+    `chat_ids` may be any iterator. The content hash and snapshot behind each
+    yielded message go into `pending` (keyed by str chat_id) so they can be
+    stored once it is delivered; unchanged chats are appended to `skipped`.
+    """
+    chat_ids = iter(chat_ids)
+
+    def next_batch():
+        return list(itertools.islice(chat_ids, BULK_BATCH_SIZE))
+
+    def prefetch(batch):
+        missing = [c for c in batch if local_data(c) is None]
+        return asyncio.ensure_future(fetch_bulk(missing)) if missing else None
+
+    batch = next_batch()
+    fetching = prefetch(batch)
+    while batch:
+        data = await fetching if fetching is not None else {}
+        upcoming = next_batch()
+        fetching = prefetch(upcoming)
+        for chat_id in batch:
+            parsed = local_data(chat_id) or data.get(str(chat_id))
+            if parsed is None or not parsed.rows:
+                continue
+            text, content_hash, snapshot = daily_message(chat_id, parsed)
+            if text is None:
+                if skipped is not None:
+                    skipped.append(chat_id)
+                continue
+            if pending is not None:
+                pending[str(chat_id)] = (content_hash, snapshot)
+            yield int(chat_id), split_message(text)
+        batch = upcoming
+
+
+async def send_daily_summary(app, target_chat_id=None, chat_ids=None):
+    """
+    Sends each chat its own summary.
+    If target_chat_id is provided, sends ONLY to that chat (for testing).
+    If chat_ids is provided, sends to those chats (scheduler dispatch).
+    Otherwise, sends to all subscribed chats.
+    """
     # If manual test, send to requester
     if target_chat_id:
-        await app.bot.send_message(
-            chat_id=target_chat_id,
-            text=msg,
-            parse_mode="Markdown"
-        )
+        try:
+            data = local_data(target_chat_id) or await get_data(target_chat_id)
+        except Exception as e:
+            logging.error(f"Failed to fetch data: {e}")
+            await app.bot.send_message(target_chat_id, fetch_error_text(e))
+            return
+        if not data.rows:
+            await app.bot.send_message(target_chat_id, "⚠️ No data found. Please /login first then /update.")
+            return
+        threshold = threshold_for(target_chat_id)
+        text = view_text(target_chat_id, data, ("daily", threshold), lambda: build_daily_summary(data.rows, threshold))
+        await send_chunks(functools.partial(app.bot.send_message, target_chat_id), text)
+        return
+
+    if chat_ids is None:
+        # Full run with no subscribers: nothing to do
+        if not subscribers.count_enabled():
+            return
+        chat_ids = subscribers.iter_enabled()
+
     # Else, send to all subscribers
+    pending, skipped, delivered = {}, [], []
+
+    if broadcast_pool is not None:
+        chat_ids = list(chat_ids)
+    if broadcast_pool is not None and len(chat_ids) >= BROADCAST_SHARD_MIN:
+        # Big run: render and send from the shard processes under the same rate budget
+        report, sent, skipped = await broadcast_pool.run(chat_ids)
+        delivered = [(chat_id, *payload) for chat_id, payload in sent]
+        # the shards' own counters aren't exported
+        for result, count in (("sent", report.sent), ("blocked", report.blocked),
+                              ("failed", report.failed), ("retried", report.retries)):
+            metrics.BROADCAST_MESSAGES.labels(result).inc(count)
     else:
-        for chat_id, enabled in alerts.items():
-            if enabled:
-                try:
-                    await app.bot.send_message(
-                        chat_id=int(chat_id),
-                        text=msg,
-                        parse_mode="Markdown"
-                    )
-                except Exception as e:
-                    logging.error(f"Failed to send to {chat_id}: {e}")
+        def on_sent(chat_id):
+            delivered.append((chat_id, *pending.pop(str(chat_id))))
+
+        report = await Broadcaster(app.bot, bucket=broadcast_bucket).run(
+            personalized_summaries(chat_ids, pending, skipped), parse_mode=HTML, on_sent=on_sent
+        )
+    subscribers.mark_sent(delivered)
+    metrics.BROADCAST_MESSAGES.labels("unchanged").inc(len(skipped))
+    logging.info(f"Daily summary broadcast: {report} unchanged={len(skipped)}")
+    prune_subscribers(report.blocked_chats)
+
+
+async def open_shard():
+    """Setup run once in each broadcast shard process: the stores and client personalized_summaries() reads."""
+    subscribers.open()
+    history.open()
+    await sheets.start()
+
+
+async def refresh_shard(chat_ids):
+    """
+    Run in a shard before each broadcast. The shard outlives many runs, so
+    re-read what the main process may have changed since: subscriptions
+    (sent hashes, thresholds, alert modes) and attendance snapshots.
+    """
+    subscribers.reload(chat_ids)
+    history.forget(chat_ids)
+    for chat_id in chat_ids:
+        attendance_cache.invalidate(str(chat_id))
+
+
+async def dispatch_due_summaries(context: ContextTypes.DEFAULT_TYPE):
+    """Scheduler tick: sends summaries to chats whose (spread-out) delivery time has come."""
+    due = planner.due(subscribers.enabled_subscriptions())
+    if not due:
+        return
+    # Mark first so an overlapping tick or a crash mid-send can't deliver twice
+    subscribers.mark_delivered(due)
+    logging.info(f"Dispatching daily summary to {len(due)} chats")
+    # Run as a task so a long send doesn't block (and skip) the next ticks
+    context.application.create_task(
+        send_daily_summary(context.application, chat_ids=[chat_id for chat_id, _ in due])
+    )
+
+
+def prune_subscribers(chat_ids):
+    """Removes chats that blocked the bot from the alert subscribers."""
+    if not chat_ids:
+        return
+    subscribers.remove(chat_ids)
+    logging.info(f"Pruned {len(chat_ids)} blocked chats from alerts")
 
 
 # ---------- LOGIN HANDLERS ----------
 
+@metrics.instrumented("login")
 async def login_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "🔐 *Register / Login*\n\nPlease enter your *Register Number* (KP Username):",
@@ -166,11 +503,13 @@ async def login_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return WAITING_USERNAME
 
+@metrics.instrumented("login:username")
 async def receive_username(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['register_username'] = update.message.text.strip()
     await update.message.reply_text("🔑 Now enter your *Password*:")
     return WAITING_PASSWORD
 
+@metrics.instrumented("login:password")
 async def receive_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = context.user_data.get('register_username')
     password = update.message.text.strip()
@@ -178,122 +517,181 @@ async def receive_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text("💾 Saving credentials to secure storage...")
     
-    async with httpx.AsyncClient(follow_redirects=True) as client:
-        try:
-            payload = {
-                "action": "register",
-                "chat_id": chat_id,
-                "username": username,
-                "password": password,
-                "auth_token": AUTH_TOKEN
-            }
-            r = await client.post(SHEETS_API_URL, json=payload)
-            data = r.json()
-            
-            if data.get("status") == "registered":
-                await update.message.reply_text("✅ *Registration Successful!*\nYour sheets have been created. You can now use /update.", parse_mode="Markdown")
-            else:
-                await update.message.reply_text(f"❌ Error: {data.get('message')}")
-        except Exception as e:
-             await update.message.reply_text(f"❌ Connection Error: {e}")
+    try:
+        payload = {
+            "action": "register",
+            "chat_id": chat_id,
+            "username": username,
+            "password": password,
+            "auth_token": AUTH_TOKEN
+        }
+        # Registration writes to the sheet, so it is never retried
+        data = await sheets.post_json(payload, op="register")
+
+        if data.get("status") == "registered":
+            await update.message.reply_text("✅ *Registration Successful!*\nYour sheets have been created. You can now use /update.", parse_mode="Markdown")
+        else:
+            await update.message.reply_text(f"❌ Error: {data.get('message')}")
+    except Exception as e:
+         await update.message.reply_text(f"❌ Connection Error: {e}")
 
     return ConversationHandler.END
 
+@metrics.instrumented("login:cancel")
 async def cancel_login(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Login cancelled.")
     return ConversationHandler.END
 
 # ---------- WORKER BOT LISTENER ----------
 
+@metrics.instrumented("worker_listener")
 async def listen_to_worker_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Listens to messages from the Worker Bot.
-    Format expected:
-    - CAPTCHA_REQ <chat_id> (with photo)
-    - SUCCESS <chat_id>
-    - FAIL <chat_id> <reason>
+    Format expected (see jobs.py; legacy replies without "v1 <job_id>" also work):
+    - CAPTCHA_REQ v1 <job_id> <chat_id> (with photo)
+    - SUCCESS v1 <job_id> <chat_id>
+    - FAIL v1 <job_id> <chat_id> <reason>
+    - HELLO / HEARTBEAT v1 <worker_id> [<capacity>] (worker pool membership)
     """
     msg = update.message
     if not msg: return
-    
-    text = msg.caption or msg.text or ""
-    
-    if "CAPTCHA_REQ" in text:
-        parts = text.split()
-        if len(parts) >= 2:
-            chat_id = parts[1]
-            if msg.photo:
-                try:
-                    await context.bot.copy_message(
-                        chat_id=chat_id,
-                        from_chat_id=msg.chat.id,
-                        message_id=msg.message_id,
-                        caption="Please enter this CAPTCHA:"
-                    )
-                    context.application.bot_data.setdefault('waiting_captcha_chats', set()).add(str(chat_id))
-                except Exception as e:
-                    logging.error(f"Failed to forward captcha to {chat_id}: {e}")
-                    
-    elif "SUCCESS" in text:
-        parts = text.split()
-        if len(parts) >= 2:
-            chat_id = parts[1]
+
+    control = parse_control(msg.text)
+    if control is not None:
+        await scrape_jobs.worker_message(*control)
+        return
+
+    reply = parse_message(msg.caption or msg.text)
+    if reply is None:
+        return
+    if scrape_jobs.is_retired(reply.job_id):
+        # The job was moved to another worker after this one went silent
+        logging.info(f"Ignoring late {reply.kind} for reassigned job {reply.job_id}")
+        return
+    chat_id = reply.chat_id
+
+    if reply.kind == CAPTCHA_REQ:
+        job = await scrape_jobs.captcha_requested(reply)
+        if msg.photo:
+            # Register the wait first: the user's answer may be processed
+            # concurrently as soon as the photo reaches them
+            captcha_waits.add(chat_id, job.job_id if job else reply.job_id)
             try:
-                await context.bot.send_message(chat_id=chat_id, text="✅ Update Data Complete! Fetching summary...")
-                summary_text = await get_summary_text(chat_id)
-                await context.bot.send_message(chat_id=chat_id, text=summary_text, parse_mode="Markdown")
-                if 'waiting_captcha_chats' in context.application.bot_data:
-                     context.application.bot_data['waiting_captcha_chats'].discard(str(chat_id))
+                await context.bot.copy_message(
+                    chat_id=chat_id,
+                    from_chat_id=msg.chat.id,
+                    message_id=msg.message_id,
+                    caption="Please enter this CAPTCHA:"
+                )
             except Exception as e:
-                logging.error(f"Failed to send summary to {chat_id}: {e}")
-                
-    elif "FAIL" in text:
-         parts = text.split()
-         if len(parts) >= 2:
-             chat_id = parts[1]
-             reason = " ".join(parts[2:])
-             try:
-                 await context.bot.send_message(chat_id=chat_id, text=f"❌ Update Failed: {reason}")
-                 if 'waiting_captcha_chats' in context.application.bot_data:
-                     context.application.bot_data['waiting_captcha_chats'].discard(str(chat_id))
-             except Exception as e:
-                 logging.error(f"Failed to report failure to {chat_id}: {e}")
+                captcha_waits.discard(chat_id)
+                logging.error(f"Failed to forward captcha to {chat_id}: {e}")
+
+    elif reply.kind == SUCCESS:
+        await scrape_jobs.succeeded(reply)
+        try:
+            await context.bot.send_message(chat_id=chat_id, text="✅ Update Data Complete! Fetching summary...")
+            # Sheet just changed: drop the cached copy so the summary is fresh
+            attendance_cache.invalidate(str(chat_id))
+            try:
+                history.record(chat_id, await get_data(chat_id))
+            except Exception as e:
+                logging.error(f"Failed to record history for {chat_id}: {e}")
+            await send_chunks(functools.partial(context.bot.send_message, chat_id), await get_summary_text(chat_id))
+        except Exception as e:
+            logging.error(f"Failed to send summary to {chat_id}: {e}")
+
+    elif reply.kind == FAIL:
+        await scrape_jobs.failed(reply)
+        try:
+            await context.bot.send_message(chat_id=chat_id, text=f"❌ Update Failed: {reply.rest}")
+        except Exception as e:
+            logging.error(f"Failed to report failure to {chat_id}: {e}")
+
+def ordering_key(update):
+    """
+    Update ordering for ChatOrderedUpdateProcessor. The communication group
+    isn't one queue: worker replies are ordered per user chat they concern
+    (a CAPTCHA_REQ before its SUCCESS), and HELLO/HEARTBEAT not at all, so
+    heartbeats never wait behind a SUCCESS doing its Sheets fetch.
+    """
+    msg = update.message if isinstance(update, Update) else None
+    if msg is not None and COMMUNICATION_GROUP_ID and str(msg.chat.id) == COMMUNICATION_GROUP_ID.strip():
+        text = msg.caption or msg.text
+        if parse_control(text) is not None:
+            return None
+        reply = parse_message(text)
+        if reply is not None:
+            return f"worker:{reply.chat_id}"
+    return update_key(update)
+
 # ---------- LOGIC HELPERS ----------
 
 async def get_summary_text(chat_id):
+    """HTML summary for chat_id (or an escaped error message)."""
     try:
-        rows = await fetch_data(chat_id)
-        if not rows: return "⚠️ No data found. Please /login first then /update."
+        data = await get_data(chat_id)
+        if not data.rows: return "⚠️ No data found. Please /login first then /update."
     except Exception as e:
-        return f"⚠️ Error fetching data: {e}"
+        return escape_html(fetch_error_text(e))
+    return summary_text(chat_id, data)
 
-    msg = "📊 *Attendance Summary*\n\n"
-    for r in rows:
-        # Assuming R[0]=Subject, R[1]=Type, R[4]=Pct (decimal)
-        # Check if row has enough cols
-        if len(r) > 4:
-            msg += f"{r[0]} ({r[1]}): {float(r[4])*100:.1f}%\n"
-    return msg
+def summary_text(chat_id, data):
+    return view_text(chat_id, data, ("summary",), lambda: T_SUMMARY() + "".join(T_SUBJECT_PCT(r=r) for r in data.rows))
 
 async def get_below85_text(chat_id):
     try:
-        rows = await fetch_data(chat_id)
-        if not rows: return "⚠️ No data found. Please /login first then /update."
+        data = await get_data(chat_id)
+        if not data.rows: return "⚠️ No data found. Please /login first then /update."
     except Exception as e:
-        return f"⚠️ Error fetching data: {e}"
-
-    bad = [r for r in rows if len(r)>4 and float(r[4]) < 0.85]
-    if not bad:
-        return "✅ All subjects above 85%"
-
-    msg = "⚠️ *Below 85%*\n\n"
-    for r in bad:
-        msg += f"{r[0]} ({r[1]}): {float(r[4])*100:.1f}%\n"
-    return msg
+        return escape_html(fetch_error_text(e))
+    return below_text(chat_id, data, threshold_for(chat_id))
+
+def below_text(chat_id, data, threshold):
+    def build():
+        bad = [r for r in data.rows if r.pct < threshold]
+        if not bad:
+            return T_ALL_ABOVE(target=format_threshold(threshold))
+        return T_BELOW(target=format_threshold(threshold)) + "".join(T_SUBJECT_PCT(r=r) for r in bad)
+    return view_text(chat_id, data, ("below", threshold), build)
+
+# ---------- ADMISSION ----------
+
+# Menu buttons that cost the same as their command
+BUTTON_ADMISSION = {"cmd_summary": READ, "cmd_below85": READ, "pick": READ}
+
+def over_budget(chat_id, kind):
+    """None if the chat may run a `kind` request now, else the "try again" reply."""
+    if str(chat_id) in ADMIN_CHAT_IDS:
+        return None
+    wait = admission.check(chat_id, kind)
+    if not wait:
+        return None
+    metrics.ADMISSION_REJECTED.labels(kind).inc()
+    return retry_text(wait)
+
+def admitted(kind):
+    """Decorator for command handlers: answers with a retry hint instead of running when over budget."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(update, context, *args, **kwargs):
+            text = over_budget(update.effective_chat.id, kind)
+            if text:
+                await update.message.reply_text(text)
+                return
+            return await fn(update, context, *args, **kwargs)
+        return wrapper
+    return decorator
 
 # ---------- HANDLERS ----------
 
+@metrics.instrumented("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.args == ["update"]:
+        # deep link from the inline-mode "Run /update" button
+        await trigger_update(update, context)
+        return
     keyboard = [
         [InlineKeyboardButton("Menu", callback_data="main_menu")],
         [InlineKeyboardButton("🔄 Update Attendance", callback_data="cmd_update")]
@@ -305,44 +703,68 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="Markdown"
     )
 
+@metrics.instrumented("update")
 async def trigger_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = str(update.effective_chat.id)
-    
+
+    async def reply(text, **kwargs):
+        if update.callback_query:
+            await update.callback_query.edit_message_text(text, **kwargs)
+        else:
+            await update.message.reply_text(text, **kwargs)
+
     # Send Signal to Communication Group
     if not COMMUNICATION_GROUP_ID:
-        await update.message.reply_text("❌ Configuration Error: COMMUNICATION_GROUP_ID not set.")
+        await reply("❌ Configuration Error: COMMUNICATION_GROUP_ID not set.")
         return
 
+    # Taps while a job is running just report on it, so only new scrapes are charged
+    if not scrape_jobs.active(chat_id):
+        text = over_budget(chat_id, SCRAPE)
+        if text:
+            await reply(text)
+            return
+
     try:
-        msg_text = f"REQ_SCRAPE {chat_id}"
-        group_id = int(COMMUNICATION_GROUP_ID)
-        await context.bot.send_message(chat_id=group_id, text=msg_text)
-        
-        status_msg = "📡 *Signal Sent to Worker via Telegram*\nWait for CAPTCHA..."
-        
-        if update.callback_query:
-            await update.callback_query.edit_message_text(status_msg, parse_mode="Markdown")
+        job, created = await scrape_jobs.submit(chat_id)
+
+        if not created:
+            status_msg = f"⏳ An update is already in progress (*{job.state}*). Please wait..."
+        elif job.state == FAILED:
+            status_msg = f"Error triggering worker: {job.reason}"
+        elif job.state == QUEUED:
+            status_msg = (
+                f"🕒 *Update queued* - you are #{scrape_jobs.position(job)} in line.\n"
+                "I'll send the CAPTCHA when it's your turn."
+            )
         else:
-            await update.message.reply_text(status_msg, parse_mode="Markdown")
-            
-        context.application.bot_data.setdefault('waiting_captcha_chats', set()).add(chat_id)
-        
+            status_msg = "📡 *Signal Sent to Worker via Telegram*\nWait for CAPTCHA..."
+
+        await reply(status_msg, parse_mode="Markdown")
+
     except Exception as e:
-         if update.callback_query:
-             await update.callback_query.edit_message_text(f"Error triggering worker: {e}")
-         else:
-             await update.message.reply_text(f"Error triggering worker: {e}")
+        await reply(f"Error triggering worker: {e}")
+
 
 
+def button_label(update):
+    # "pick:bunk:3" -> "button:pick"
+    return "button:" + (update.callback_query.data or "").split(":")[0]
 
+@metrics.instrumented(button_label)
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
+    kind = BUTTON_ADMISSION.get((query.data or "").split(":")[0])
+    text = over_budget(update.effective_chat.id, kind) if kind else None
+    if text:
+        await query.answer(text, show_alert=True)
+        return
     await query.answer()
 
     if query.data == "main_menu":
         keyboard = [
             [InlineKeyboardButton("📊 Summary", callback_data="cmd_summary")],
-            [InlineKeyboardButton("⚠️ Below 85%", callback_data="cmd_below85")],
+            [InlineKeyboardButton(f"⚠️ Below {format_threshold(threshold_for(update.effective_chat.id))}", callback_data="cmd_below85")],
             [InlineKeyboardButton("📝 Attendance Help", callback_data="help_attendance")],
             [InlineKeyboardButton("🛌 Bunk Help", callback_data="help_bunk")],
             [InlineKeyboardButton("🔔 Alerts Status", callback_data="cmd_alerts_status")]
@@ -359,137 +781,525 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif query.data == "cmd_summary":
         chat_id = str(update.effective_chat.id)
-        text = await get_summary_text(chat_id)
-        await query.edit_message_text(text, parse_mode="Markdown")
+        await edit_chunks(query, await get_summary_text(chat_id))
 
     elif query.data == "cmd_below85":
         chat_id = str(update.effective_chat.id)
-        text = await get_below85_text(chat_id)
-        await query.edit_message_text(text, parse_mode="Markdown")
+        await edit_chunks(query, await get_below85_text(chat_id))
 
     elif query.data == "help_attendance":
         await query.edit_message_text("Usage:\n/attendance <subject>\n\nExample:\n/attendance python", parse_mode="Markdown")
 
     elif query.data == "help_bunk":
-        await query.edit_message_text("Usage:\n/bunk <subject>\n\nExample:\n/bunk math", parse_mode="Markdown")
+        await query.edit_message_text(BUNK_USAGE)
+
+    elif query.data.startswith("pick:"):
+        # pick:<view>:<positions>[:<threshold>]
+        _, view, picked, *rest = query.data.split(":")
+        threshold = parse_threshold(rest[0]) if rest else threshold_for(update.effective_chat.id)
+        try:
+            data = await get_data(update.effective_chat.id)
+        except Exception as e:
+            await query.edit_message_text(fetch_error_text(e))
+            return
+        positions = [int(i) for i in picked.split(",")]
+        chosen = [data.rows[i] for i in positions if i < len(data.rows)]
+        if view not in SUBJECT_VIEWS or not chosen:
+            await query.edit_message_text("❌ Subject not found. Please try again.")
+            return
+        await edit_chunks(query, subject_text(update.effective_chat.id, data, view, chosen, threshold))
 
     elif query.data == "cmd_alerts_status":
-        alerts = load_alerts()
-        chat_id = str(update.effective_chat.id)
-        status = alerts.get(chat_id, False)
         await query.edit_message_text(
-            f"🔔 Daily alerts are *{'ON' if status else 'OFF'}*\nUse /alerts on|off to change.",
+            alerts_status_text(update.effective_chat.id) + "\nUse /alerts on|off to change.",
             parse_mode="Markdown"
         )
 
+@metrics.instrumented("summary")
+@admitted(READ)
 async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = await get_summary_text(str(update.effective_chat.id))
-    await update.message.reply_text(text, parse_mode="Markdown")
+    await send_chunks(update.message.reply_text, await get_summary_text(str(update.effective_chat.id)))
 
+@metrics.instrumented("below85")
+@admitted(READ)
 async def below85(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = await get_below85_text(str(update.effective_chat.id))
-    await update.message.reply_text(text, parse_mode="Markdown")
+    await send_chunks(update.message.reply_text, await get_below85_text(str(update.effective_chat.id)))
 
-async def attendance(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not context.args:
-        await update.message.reply_text("Usage: /attendance <subject>")
+def format_attendance(rows, threshold=DEFAULT_THRESHOLD):
+    msg = ""
+    for r in rows:
+        msg += T_ATTENDANCE(r=r)
+        # rows restored from history snapshots carry no sheet status
+        msg += T_STATUS(status=r.status) if r.status else "\n"
+    return msg
+
+def describe_plan(p, threshold):
+    target = format_threshold(threshold)
+    if p.skip:
+        return f"✅ Can skip {p.skip} class(es) and stay at or above {target}"
+    if p.need is None:
+        return f"❌ {target} can no longer be reached"
+    if p.need:
+        return f"⚠️ Attend the next {p.need} class(es) to get back to {target}"
+    return f"➖ Right at {target}: skipping the next class drops you below it"
+
+def format_bunk(rows, threshold=DEFAULT_THRESHOLD):
+    msg = ""
+    for p in plan(rows, threshold):
+        msg += T_BUNK(r=p.row, pct=p.pct, plan=describe_plan(p, threshold))
+    return msg
+
+# view(rows, threshold) -> HTML reply text
+SUBJECT_VIEWS = {"attendance": format_attendance, "bunk": format_bunk}
+MAX_PICK_BUTTONS = 8
+
+def subject_text(chat_id, data, view, rows, threshold):
+    positions = tuple(data.rows.index(r) for r in rows)
+    return view_text(chat_id, data, (view, positions, threshold), lambda: SUBJECT_VIEWS[view](rows, threshold))
+
+BUNK_USAGE = (
+    "Usage:\n"
+    "/bunk [subject] [threshold]\n"
+    "/whatif <subject> skip 3 of 10\n"
+    "/threshold [percent|reset]\n\n"
+    "Examples:\n"
+    "/bunk math\n"
+    "/bunk math 75\n"
+    "/bunk 80%  (every subject)"
+)
+
+def split_threshold(args, index):
+    """
+    Peels an optional trailing threshold ("80%", "80", "0.8") off command args.
+    "80%" always is one; a bare number only when the args before it still
+    name a subject in `index` at least as well as with it ("Maths 12").
+    """
+    if not args:
+        return args, None
+    last, rest = args[-1], args[:-1]
+    try:
+        value = float(last.rstrip("%"))
+    except ValueError:
+        return args, None
+    if not last.endswith("%"):
+        # "Maths 2" is a subject, not a 2% target
+        if not (value >= 10 or ("." in last and value <= 1)):
+            return args, None
+        if rest:
+            without, whole = index.search(" ".join(rest)), index.search(" ".join(args))
+            if not without or (whole and whole[0][1] > without[0][1]):
+                return args, None
+    try:
+        return rest, parse_threshold(last)
+    except ValueError:
+        return args, None
+
+async def subject_lookup(update: Update, context: ContextTypes.DEFAULT_TYPE, view):
+    """Shared body of /attendance and /bunk: resolve the subject, or ask which one was meant."""
+    usage = f"Usage: /{view} <subject>"
+    if not context.args and view != "bunk":
+        await update.message.reply_text(usage)
         return
 
     try:
-        rows = await fetch_data(str(update.effective_chat.id))
+        data = await get_data(update.effective_chat.id)
     except Exception as e:
-        await update.message.reply_text(f"⚠️ Error fetching data: {e}")
+        await update.message.reply_text(fetch_error_text(e))
         return
-    
-    if not rows:
+
+    if not data.rows:
          await update.message.reply_text("⚠️ No data found. Please /login first.")
          return
 
-    query = " ".join(context.args)
-    matches = match_subject(query, rows)
+    # needs the subjects: "Maths 12" keeps its 12, "maths 75" is a 75% target
+    args, threshold = split_threshold(context.args or [], data.index)
+    if threshold is None:
+        threshold = threshold_for(update.effective_chat.id)
+    if not args and view != "bunk":
+        await update.message.reply_text(usage)
+        return
+
+    if not args:
+        # bare /bunk [threshold]: every subject in one pass
+        await send_chunks(update.message.reply_text, subject_text(update.effective_chat.id, data, view, data.rows, threshold))
+        return
+
+    query = " ".join(args)
+    best, candidates = data.index.lookup(query)
 
-    if not matches:
+    if not candidates:
         await update.message.reply_text("❌ Subject not found")
         return
 
-    msg = ""
-    for r in matches:
-        msg += (
-            f"{r[0]} ({r[1]})\n"
-            f"Conducted: {r[2]}\n"
-            f"Present: {r[3]}\n"
-            f"Attendance: {r[4]*100:.1f}%\n"
-            f"Status: {r[5]}\n\n"
-        )
-    await update.message.reply_text(msg)
+    if best:
+        await send_chunks(update.message.reply_text, subject_text(update.effective_chat.id, data, view, [best], threshold))
+        return
 
+    # Several equally good matches: let the user pick (callback data is capped at 64 bytes)
+    positions = [data.rows.index(r) for r in candidates[:MAX_PICK_BUTTONS]]
+    suffix = f":{format_threshold(threshold)}"  # explicit %, so 1% can't read back as 100%
+    keyboard = [
+        [InlineKeyboardButton(f"{r.subject} ({r.type})", callback_data=f"pick:{view}:{i}{suffix}")]
+        for r, i in zip(candidates, positions)
+    ]
+    keyboard.append([InlineKeyboardButton("Show all", callback_data=f"pick:{view}:{','.join(map(str, positions))}{suffix}")])
+    await update.message.reply_text(
+        f"🔎 Several subjects match \"{query}\". Which one?",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+@metrics.instrumented("attendance")
+@admitted(READ)
+async def attendance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await subject_lookup(update, context, "attendance")
+
+@metrics.instrumented("bunk")
+@admitted(READ)
 async def bunk(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not context.args:
-        await update.message.reply_text("Usage: /bunk <subject>")
+    await subject_lookup(update, context, "bunk")
+
+
+# ---------- BUNK PLANNER ----------
+
+WHATIF_USAGE = (
+    "Usage:\n"
+    "/whatif <subject> skip <n> [of <m>] [threshold]\n"
+    "/whatif <subject> attend <n> [of <m>] [threshold]\n\n"
+    "Example:\n"
+    "/whatif python skip 3 of 10"
+)
+
+def parse_whatif(args):
+    """
+    Splits /whatif args into (subject query, attend, skip, threshold or None);
+    raises ValueError. The skip/attend clause is read first, so only a token
+    after it can be a threshold ("skip 3 of 10" is not a 10% target).
+    """
+    verbs = [i for i, a in enumerate(args) if a.lower() in ("skip", "attend")]
+    if not verbs or verbs[-1] == 0:
+        raise ValueError("Tell me the subject and what you plan to skip or attend.")
+    i = verbs[-1]
+    verb, rest = args[i].lower(), args[i + 1:]
+    try:
+        n = int(rest[0])
+        if len(rest) >= 3 and rest[1].lower() == "of":
+            total, rest = int(rest[2]), rest[3:]
+        else:
+            total, rest = n, rest[1:]
+    except (IndexError, ValueError):
+        raise ValueError("Expected a number of classes, e.g. skip 3 or skip 3 of 10.")
+    if n < 0 or total < n:
+        raise ValueError("The number of classes doesn't add up.")
+    if len(rest) > 1:
+        raise ValueError(f"Unexpected \"{' '.join(rest)}\" after the number of classes.")
+    threshold = parse_threshold(rest[0]) if rest else None
+    if verb == "skip":
+        return " ".join(args[:i]), total - n, n, threshold
+    return " ".join(args[:i]), n, total - n, threshold
+
+@metrics.instrumented("whatif")
+@admitted(READ)
+async def whatif(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        query, attend, skip, threshold = parse_whatif(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n\n{WHATIF_USAGE}")
         return
+    if threshold is None:
+        threshold = threshold_for(update.effective_chat.id)
 
     try:
-        rows = await fetch_data(str(update.effective_chat.id))
+        data = await get_data(update.effective_chat.id)
     except Exception as e:
-        await update.message.reply_text(f"⚠️ Error fetching data: {e}")
+        await update.message.reply_text(fetch_error_text(e))
+        return
+    if not data.rows:
+        await update.message.reply_text("⚠️ No data found. Please /login first.")
         return
-    
-    if not rows:
-         await update.message.reply_text("⚠️ No data found. Please /login first.")
-         return
-
-    query = " ".join(context.args)
-    matches = match_subject(query, rows)
 
-    if not matches:
+    best, candidates = data.index.lookup(query)
+    if not candidates:
         await update.message.reply_text("❌ Subject not found")
         return
+    if not best:
+        names = ", ".join(f"{r.subject} ({r.type})" for r in candidates[:MAX_PICK_BUTTONS])
+        await update.message.reply_text(f"🔎 \"{query}\" matches several subjects: {names}. Please be more specific.")
+        return
 
-    msg = ""
-    for r in matches:
-        msg += f"{r[0]} ({r[1]})\n{r[6]}\n\n"
+    r = best
+    conducted, present = what_if(r.conducted, r.present, attend=attend, skip=skip)
+    now = assess(r.conducted, r.present, threshold, r)
+    after = assess(conducted, present, threshold, r)
+    verdict = "✅ stays at or above" if after.pct >= threshold else "⚠️ drops below"
+    await update.message.reply_text(
+        stale_note(data) +
+        f"{r.subject} ({r.type})\n"
+        f"Now: {r.present}/{r.conducted} = {pct(now.pct)}\n"
+        f"Attend {attend}, skip {skip}: {present}/{conducted} = {pct(after.pct)}\n"
+        f"{verdict} {format_threshold(threshold)}\n\n"
+        f"Afterwards: {describe_plan(after, threshold)}"
+    )
 
+@metrics.instrumented("threshold")
+async def threshold_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = str(update.effective_chat.id)
+    if context.args:
+        arg = context.args[0].lower()
+        try:
+            subscribers.set_threshold(chat_id, None if arg in ("reset", "default") else parse_threshold(arg))
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {e}\n\nUsage: /threshold [percent|reset]")
+            return
+    await update.message.reply_text(
+        f"🎯 Your attendance target is {format_threshold(threshold_for(chat_id))}.\n"
+        f"/bunk, /below85 and daily summaries use it. Change it with /threshold 75."
+    )
+
+
+# ---------- HISTORY ----------
+
+HISTORY_POINTS = 10
+WEEK = 7 * 86400
+
+def format_change(delta):
+    if delta is None:
+        return "no change data yet"
+    return f"{delta * 100:+.1f} pts this week"
+
+@metrics.instrumented("history")
+async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/history [subject]: trends from local snapshots, no Sheets round-trip."""
+    chat_id = str(update.effective_chat.id)
+    latest = history.latest(chat_id)
+    if latest is None:
+        await update.message.reply_text("📈 No history yet. Every successful /update records a snapshot.")
+        return
+
+    snapshots = history.range(chat_id, since=time.time() - TREND_WINDOW)
+    if not context.args:
+        msg = f"📈 Attendance trends (as of {time.strftime('%d %b %H:%M', time.localtime(latest.fetched_at))})\n\n"
+        for r in latest.rows:
+            series = subject_series(snapshots, r.subject, r.type)
+            msg += f"{r.subject} ({r.type}): {pct(r.pct)}, {format_change(change_since(series, WEEK))}\n"
+        msg += "\nUse /history <subject> for details."
+        await send_chunks(update.message.reply_text, msg, parse_mode=None)
+        return
+
+    query = " ".join(context.args)
+    best, candidates = latest.index.lookup(query)
+    if not candidates:
+        await update.message.reply_text("❌ Subject not found")
+        return
+    r = best or candidates[0]
+    series = subject_series(history.range(chat_id), r.subject, r.type)
+
+    msg = f"📈 {r.subject} ({r.type})\n\n"
+    for taken_at, conducted, present in series[-HISTORY_POINTS:]:
+        day = time.strftime("%d %b", time.localtime(taken_at))
+        msg += f"{day}: {present}/{conducted} = {pct(present / conducted if conducted else 0.0)}\n"
+    msg += f"\nWeekly change: {format_change(change_since(series, WEEK))}\n"
+
+    until = term_end()
+    projected = project(series, until)
+    when = time.strftime("%d %b", time.localtime(until))
+    if projected is None:
+        msg += f"Projection to {when}: needs at least a day of history with classes held"
+    else:
+        msg += f"Projected by {when} at the recent rate: {pct(projected)}"
     await update.message.reply_text(msg)
 
 
+# ---------- INLINE MODE ----------
+
+# "@bot dbms" in any chat, answered only from data already on hand (never
+# GAS). Needs inline mode enabled for the bot in @BotFather.
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "120"))  # seconds Telegram may reuse an answer
+INLINE_STALE_CACHE_TIME = int(os.getenv("INLINE_STALE_CACHE_TIME", "10"))  # ...when data is old or missing
+INLINE_MAX_RESULTS = 20
+
+def inline_article(result_id, title, description, text, parse_mode=None):
+    return InlineQueryResultArticle(
+        id=result_id,
+        title=title,
+        description=description,
+        input_message_content=InputTextMessageContent(text, parse_mode=parse_mode),
+    )
+
+def inline_results(chat_id, data, query, threshold):
+    """Summary and below-threshold cards for an empty query, else the best-matching subjects."""
+    results = []
+    if query:
+        rows = [r for r, _ in data.index.search(query)]
+    else:
+        rows = data.rows
+        results.append(inline_article(
+            "summary", "📊 Attendance Summary", f"{len(data.rows)} subjects", summary_text(chat_id, data), HTML
+        ))
+        below = sum(1 for r in data.rows if r.pct < threshold)
+        results.append(inline_article(
+            "below", f"⚠️ Below {format_threshold(threshold)}", f"{below} subject(s)",
+            below_text(chat_id, data, threshold), HTML,
+        ))
+    for r in rows[:INLINE_MAX_RESULTS - len(results)]:
+        p = assess(r.conducted, r.present, threshold, r)
+        results.append(inline_article(
+            f"row:{data.rows.index(r)}",
+            f"{r.subject} ({r.type}) - {pct(p.pct)}",
+            describe_plan(p, threshold),
+            subject_text(chat_id, data, "bunk", [r], threshold),
+            HTML,
+        ))
+    return results
+
+@metrics.instrumented("inline")
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.inline_query
+    chat_id = str(query.from_user.id)
+    data = local_data(chat_id)
+    update_button = InlineQueryResultsButton(text="🔄 Run /update", start_parameter="update")
+
+    if data is None:
+        await query.answer(
+            [inline_article(
+                "stale", "⚠️ No saved attendance yet", "Run /update in the bot chat first",
+                "⚠️ No saved attendance yet. Open the bot and run /update.",
+            )],
+            cache_time=INLINE_STALE_CACHE_TIME, is_personal=True, button=update_button,
+        )
+        return
+
+    results = inline_results(chat_id, data, query.query.strip(), threshold_for(chat_id))
+    if not results:
+        results = [inline_article("none", "❌ Subject not found", f"Nothing matches \"{query.query}\"",
+                                  f"❌ No subject matches \"{query.query}\"")]
+    # Don't let Telegram keep serving an answer past the data's freshness
+    age = time.time() - data.fetched_at
+    stale = age >= CACHE_TTL
+    cache_time = INLINE_STALE_CACHE_TIME if stale else max(INLINE_STALE_CACHE_TIME, min(INLINE_CACHE_TIME, int(CACHE_TTL - age)))
+    await query.answer(
+        results, cache_time=cache_time, is_personal=True, button=update_button if stale else None,
+    )
+
+
 # ---------- ALERT COMMAND ----------
 
+ALERTS_USAGE = (
+    "Usage:\n"
+    "/alerts on [HH:MM] [Area/City]\n"
+    "/alerts off\n"
+    "/alerts time HH:MM\n"
+    "/alerts tz Area/City\n"
+    "/alerts mode full|changes|diff\n"
+    "/alerts status\n\n"
+    "Modes: full = every day, changes = only when your attendance changed, "
+    "diff = only the subjects that changed"
+)
+
+def alerts_status_text(chat_id):
+    sub = subscribers.get(chat_id)
+    if sub is None or not sub.enabled:
+        return "🔔 Daily alerts are *OFF*"
+    mode = sub.alert_mode or DEFAULT_ALERT_MODE
+    return f"🔔 Daily alerts are *ON* (`{planner.describe(sub)}`, mode `{mode}`)"
+
+def parse_schedule_args(args):
+    """Pulls an optional HH:MM and timezone out of /alerts arguments; raises ValueError."""
+    delivery_time = tz = None
+    for arg in args:
+        if ":" in arg:
+            delivery_time = parse_time(arg)
+        else:
+            resolve_tz(arg)
+            tz = arg
+    return delivery_time, tz
+
+def skip_passed_slot(chat_id):
+    """
+    Catch-up is for runs missed across a restart: a slot that had already
+    passed when alerts were enabled or moved counts as done, so the first
+    summary comes at the next slot instead of within a minute.
+    """
+    sub = subscribers.get(chat_id)
+    day = planner.last_passed(sub)
+    if day is not None and (sub.last_delivered or "") < day:
+        subscribers.mark_delivered([(chat_id, day)])
+
+@metrics.instrumented("alerts")
 async def alerts_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    alerts = load_alerts()
     chat_id = str(update.effective_chat.id)
 
     if not context.args:
-        status = alerts.get(chat_id, False)
-        await update.message.reply_text(
-            f"🔔 Daily alerts are *{'ON' if status else 'OFF'}*",
-            parse_mode="Markdown"
-        )
+        await update.message.reply_text(alerts_status_text(chat_id), parse_mode="Markdown")
         return
 
     arg = context.args[0].lower()
-    if arg == "on":
-        alerts[chat_id] = True
-        save_alerts(alerts)
-        await update.message.reply_text("✅ Daily alerts ENABLED (9:00 AM)")
-    elif arg == "off":
-        alerts.pop(chat_id, None)
-        save_alerts(alerts)
-        await update.message.reply_text("❌ Daily alerts DISABLED")
-    elif arg == "status":
-        status = alerts.get(chat_id, False)
-        await update.message.reply_text(
-            f"🔔 Daily alerts are *{'ON' if status else 'OFF'}*",
-            parse_mode="Markdown"
-        )
-    else:
-        await update.message.reply_text("Usage: /alerts on | off | status")
+    try:
+        if arg == "on":
+            delivery_time, tz = parse_schedule_args(context.args[1:])
+            subscribers.set_enabled(chat_id, True)
+            subscribers.set_schedule(chat_id, tz=tz, delivery_time=delivery_time)
+            skip_passed_slot(chat_id)
+            sub = subscribers.get(chat_id)
+            await update.message.reply_text(f"✅ Daily alerts ENABLED ({planner.describe(sub)})")
+        elif arg == "off":
+            subscribers.set_enabled(chat_id, False)
+            await update.message.reply_text("❌ Daily alerts DISABLED")
+        elif arg in ("time", "tz") and len(context.args) == 2:
+            delivery_time, tz = parse_schedule_args(context.args[1:])
+            subscribers.set_schedule(chat_id, tz=tz, delivery_time=delivery_time)
+            skip_passed_slot(chat_id)
+            await update.message.reply_text(alerts_status_text(chat_id), parse_mode="Markdown")
+        elif arg == "mode" and len(context.args) == 2:
+            mode = context.args[1].lower()
+            if mode not in ALERT_MODES:
+                raise ValueError(f"Unknown mode {context.args[1]}")
+            subscribers.set_alert_mode(chat_id, mode)
+            await update.message.reply_text(alerts_status_text(chat_id), parse_mode="Markdown")
+        elif arg == "status":
+            await update.message.reply_text(alerts_status_text(chat_id), parse_mode="Markdown")
+        else:
+            await update.message.reply_text(ALERTS_USAGE)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n\n{ALERTS_USAGE}")
 
+@metrics.instrumented("testdaily")
+@admitted(PREVIEW)
 async def test_daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🔄 Generating preview...")
     # Pass the current app and the requester's chat ID
     await send_daily_summary(context.application, target_chat_id=update.effective_chat.id)
 
 
+def stats_text():
+    """Plain-text snapshot of the hot-path metrics for /stats."""
+    lines = [f"📈 Stats (uptime {time.time() - metrics.STARTED:.0f}s, ready in {metrics.READY_SECONDS.labels().value:.2f}s)", ""]
+    lines.append("Handlers (count / p95):")
+    for (label,), child in sorted(metrics.HANDLER_SECONDS._children.items()):
+        lines.append(f"  {label}: {child.count} / {child.quantile(0.95) * 1000:.0f}ms")
+    lines.append("Sheets (count / p95):")
+    for (op, result), child in sorted(metrics.SHEETS_SECONDS._children.items()):
+        lines.append(f"  {op} {result}: {child.count} / {child.quantile(0.95) * 1000:.0f}ms")
+    cache = attendance_cache.stats()
+    lines.append(f"Sheets breaker: {sheets.breaker.state} ({sheets.breaker.failures} consecutive failures)")
+    lines.append(f"Cache: {cache['entries']} chats, hit ratio {cache['hit_ratio']:.0%}, {cache['loads']} loads")
+    lines.append(f"Rendered: {rendered.stats()}")
+    lines.append(f"Jobs: {scrape_jobs.stats()}")
+    lines.append(f"Admission: {admission.stats()}")
+    lines.append(f"Workers: {scrape_jobs.pool.stats() if scrape_jobs.pool else 'single legacy worker'}")
+    lines.append(f"CAPTCHA: {captcha_waits.stats()}")
+    lines.append(f"Subscribers: {subscribers.count_enabled()}")
+    lines.append(f"History: {history.stats()}")
+    return "\n".join(lines)
+
+@metrics.instrumented("stats")
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if str(update.effective_chat.id) not in ADMIN_CHAT_IDS:
+        await update.message.reply_text("I didn't understand that. Use /start for menu.")
+        return
+    await update.message.reply_text(stats_text())
+
+
+@metrics.instrumented("text")
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check if we are waiting for something?
     # Actually, simplistic approach: if user initiates update, we assume next text might be captcha.
@@ -497,10 +1307,12 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Being explicit is better.
     
     chat_id = str(update.effective_chat.id)
-    waiting_chats = context.application.bot_data.get('waiting_captcha_chats', set())
-    
-    if chat_id in waiting_chats:
+
+    if chat_id in captcha_waits:
         text = update.message.text
+        latency = captcha_waits.answered(chat_id)
+        if latency is not None:
+            logging.info(f"CAPTCHA round-trip for {chat_id}: {latency:.1f}s")
         await update.message.reply_text(f"📤 Forwarding response to worker...")
         
         if not COMMUNICATION_GROUP_ID:
@@ -508,7 +1320,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
              return
 
         try:
-            cmd = f"CAPTCHA_SOL {chat_id} {text}"
+            cmd = scrape_jobs.captcha_solution(chat_id, text, captcha_waits.job_id(chat_id))
             group_id = int(COMMUNICATION_GROUP_ID)
             await context.bot.send_message(chat_id=group_id, text=cmd)
         except Exception as e:
@@ -520,8 +1332,128 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ---------- MAIN ----------
 
-def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+async def sweep_jobs(context: ContextTypes.DEFAULT_TYPE):
+    await scrape_jobs.sweep()
+
+
+async def sweep_captcha_waits(context: ContextTypes.DEFAULT_TYPE):
+    for chat_id in captcha_waits.sweep():
+        try:
+            await context.bot.send_message(chat_id=chat_id, text="⌛ CAPTCHA expired. Use /update to try again.")
+        except Exception as e:
+            logging.error(f"Failed to notify {chat_id} of CAPTCHA expiry: {e}")
+
+
+def warm_cache():
+    """
+    Seeds the attendance cache from the newest history snapshots, most
+    recently updated chats first, so reads right after a restart are served
+    locally (and refreshed in the background) instead of all going to GAS.
+    """
+    chat_ids = history.recent_chats(attendance_cache.max_entries)
+    # oldest first, so the LRU order matches recency
+    for chat_id in reversed(chat_ids):
+        data = history.latest(chat_id)
+        if data is not None:
+            attendance_cache.restore(chat_id, data)
+    return len(chat_ids)
+
+
+async def post_init(application):
+    global metrics_server, broadcast_pool
+    subscribers.open()
+    captcha_waits.open()
+    history.open()
+    await sheets.start()
+
+    bot = application.bot
+
+    async def send_to_worker(text):
+        await bot.send_message(chat_id=int(COMMUNICATION_GROUP_ID), text=text)
+
+    async def notify_user(chat_id, text):
+        await bot.send_message(chat_id=chat_id, text=text)
+
+    def job_finished(job):
+        captcha_waits.discard(job.chat_id)
+        metrics.JOBS_FINISHED.labels(job.state).inc()
+
+    def job_reassigned(job, old_job_id):
+        # A CAPTCHA from the silent worker can no longer be answered
+        captcha_waits.discard(job.chat_id)
+
+    scrape_jobs.send = send_to_worker
+    scrape_jobs.notify = notify_user
+    scrape_jobs.on_finish = job_finished
+    scrape_jobs.on_reassign = job_reassigned
+    application.job_queue.run_repeating(sweep_jobs, interval=15, first=15)
+    application.job_queue.run_repeating(sweep_captcha_waits, interval=30, first=30)
+    # Daily summaries: per-chat time/timezone, checked on the bot's own event loop
+    application.job_queue.run_repeating(dispatch_due_summaries, interval=SCHEDULER_TICK, first=5)
+
+    if BROADCAST_SHARDS > 1:
+        broadcast_pool = ShardPool(
+            BROADCAST_SHARDS, personalized_summaries, token=bot.token, base_url=bot.base_url,
+            bucket=broadcast_bucket, setup=open_shard, prepare=refresh_shard, parse_mode=HTML,
+        ).start()
+
+    register_collectors()
+    metrics_server = await metrics.start_server()
+
+    t = time.monotonic()
+    warmed = warm_cache()
+    ready = time.monotonic() - BOOT
+    metrics.READY_SECONDS.labels().set(ready)
+    logging.info(
+        f"Ready in {ready:.2f}s: warmed {warmed} chats from history in {(time.monotonic() - t) * 1000:.0f}ms, "
+        f"{subscribers.count_enabled()} alert subscribers, {captcha_waits.stats()['waiting']} pending CAPTCHAs"
+    )
+
+
+def register_collectors():
+    """Gauges read from live state at scrape time, so the hot path pays nothing for them."""
+    metrics.CACHE.set_function(lambda: {(k,): v for k, v in attendance_cache.stats().items()})
+    metrics.RENDER_CACHE.set_function(lambda: {(k,): v for k, v in rendered.stats().items()})
+    metrics.JOB_STATES.set_function(lambda: {(k,): v for k, v in scrape_jobs.stats().items()})
+    metrics.CAPTCHA.set_function(lambda: {(k,): v for k, v in captcha_waits.stats().items()})
+    metrics.WORKERS.set_function(lambda: {(k,): v for k, v in scrape_jobs.pool.stats().items()})
+    metrics.SUBSCRIBERS.set_function(lambda: {(): subscribers.count_enabled()})
+    metrics.SHEETS_BREAKER.set_function(lambda: {(): int(sheets.breaker.state != sheets.breaker.CLOSED)})
+
+
+async def post_shutdown(application):
+    global metrics_server, broadcast_pool
+    if metrics_server is not None:
+        metrics_server.close()
+        metrics_server = None
+    if broadcast_pool is not None:
+        await broadcast_pool.close()
+        broadcast_pool = None
+    logging.info(f"Attendance cache stats: {attendance_cache.stats()}")
+    logging.info(f"CAPTCHA wait stats: {captcha_waits.stats()}")
+    await sheets.close()
+    subscribers.close()
+    captcha_waits.close()
+    history.close()
+
+
+def build_application(token=BOT_TOKEN, base_url=None, persistence_file=PERSISTENCE_FILE):
+    """Builds the Application with all handlers; `base_url` points it at another Bot API server."""
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        # Different chats run in parallel; one chat's updates stay in order
+        .concurrent_updates(ChatOrderedUpdateProcessor(key=ordering_key))
+        # Times every Bot API call for the metrics endpoint
+        .request(InstrumentedRequest())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if persistence_file:
+        builder = builder.persistence(PicklePersistence(persistence_file, update_interval=PERSISTENCE_INTERVAL))
+    app = builder.build()
 
     app.add_handler(CommandHandler("start", start))
     
@@ -532,7 +1464,10 @@ def main():
             WAITING_USERNAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_username)],
             WAITING_PASSWORD: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_password)]
         },
-        fallbacks=[CommandHandler('cancel', cancel_login)]
+        fallbacks=[CommandHandler('cancel', cancel_login)],
+        # A restart between "username" and "password" no longer drops the user out of /login
+        name="login",
+        persistent=True,
     )
     app.add_handler(login_conv)
     
@@ -541,28 +1476,18 @@ def main():
     app.add_handler(CommandHandler("below85", below85))
     app.add_handler(CommandHandler("attendance", attendance))
     app.add_handler(CommandHandler("bunk", bunk))
+    app.add_handler(CommandHandler("whatif", whatif))
+    app.add_handler(CommandHandler("threshold", threshold_cmd))
+    app.add_handler(CommandHandler("history", history_cmd))
     app.add_handler(CommandHandler("alerts", alerts_cmd))
     app.add_handler(CommandHandler("alerts", alerts_cmd))
     app.add_handler(CommandHandler("testdaily", test_daily))
     app.add_handler(CommandHandler("update", trigger_update))
+    app.add_handler(CommandHandler("stats", stats))
+    app.add_handler(InlineQueryHandler(inline_query))
     
-    # Generic Message Handler for Captcha
-    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_text))
-
-    # DAILY scheduler (9:00 AM)
-    scheduler = BackgroundScheduler()
-    # Note: send_daily_summary now requires 'app' as arg, and no target_chat_id for broadcast
-    scheduler.add_job(
-        lambda: app.create_task(send_daily_summary(app)),
-        trigger="cron",
-        hour=9,
-        minute=0
-    )
-    scheduler.start()
-
-    print("🤖 Attendance Bot V2 (Async + Group Communication) running...")
-    
-    # Register Communication Group Listener
+    # Register Communication Group Listener (before the generic text handler,
+    # which would otherwise swallow the worker's SUCCESS/FAIL text messages)
     if COMMUNICATION_GROUP_ID:
         try:
             group_id = int(COMMUNICATION_GROUP_ID)
@@ -573,7 +1498,18 @@ def main():
     else:
         print("⚠️ COMMUNICATION_GROUP_ID not set. Communication will fail.")
 
-    app.run_polling()
+    # Generic Message Handler for Captcha
+    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_text))
+    return app
+
+
+def main():
+    app = build_application()
+
+    print("🤖 Attendance Bot V2 (Async + Group Communication) running...")
+    
+    # Webhook if WEBHOOK_URL is set, polling otherwise
+    run(app)
 
 
 if __name__ == "__main__":
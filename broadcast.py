@@ -0,0 +1,216 @@
+import asyncio
+import datetime
+import logging
+import os
+import random
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+import metrics
+
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "30"))              # Telegram global ~30 msg/s
+BROADCAST_PER_CHAT_RATE = float(os.getenv("BROADCAST_PER_CHAT_RATE", "1"))  # ~1 msg/s per chat
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+BROADCAST_BACKOFF = float(os.getenv("BROADCAST_BACKOFF", "1.0"))
+
+# BadRequest messages that mean the chat is gone for good
+_DEAD_CHAT_ERRORS = ("chat not found", "user is deactivated", "peer_id_invalid")
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds):
+        """Stops handing out tokens for `seconds` (global flood wait)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        # The lock keeps waiters FIFO instead of letting them race for refills
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastReport:
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retries = 0
+        self.blocked_chats = []
+        self.started = time.monotonic()
+        self.duration = 0.0
+
+    def as_dict(self):
+        """The counters (blocked_chats travel separately, see Broadcaster.run's on_blocked)."""
+        return {"sent": self.sent, "failed": self.failed, "blocked": self.blocked, "retries": self.retries}
+
+    def add(self, counts):
+        """Folds another report's as_dict() into this one (sharded broadcasts)."""
+        self.sent += counts["sent"]
+        self.failed += counts["failed"]
+        self.blocked += counts["blocked"]
+        self.retries += counts["retries"]
+
+    def __str__(self):
+        return (
+            f"sent={self.sent} failed={self.failed} blocked={self.blocked} "
+            f"retries={self.retries} duration={self.duration:.1f}s"
+        )
+
+
+def _retry_seconds(exc):
+    # PTB exposes retry_after as int or timedelta depending on version/settings
+    value = exc.retry_after
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+class Broadcaster:
+    """
+    Sends many messages with bounded concurrency under a global token bucket
+    and per-chat limits. RetryAfter and transient network errors are retried
+    with backoff; chats that blocked the bot are collected in the report.
+    `bucket` replaces the global token bucket (anything with async acquire()
+    and pause(seconds), e.g. a shard's handle on the parent's bucket).
+    """
+
+    def __init__(self, bot, concurrency=BROADCAST_CONCURRENCY, rate=BROADCAST_RATE,
+                 per_chat_rate=BROADCAST_PER_CHAT_RATE, max_retries=BROADCAST_MAX_RETRIES,
+                 backoff=BROADCAST_BACKOFF, bucket=None):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.bucket = bucket if bucket is not None else TokenBucket(rate)
+        self.per_chat_rate = per_chat_rate
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._chat_buckets = {}
+
+    async def run(self, messages, parse_mode=None, on_sent=None, on_blocked=None):
+        """
+        `messages` is an iterable or async iterable of (chat_id, text) pairs;
+        text may also be a list of chunks, sent in order as separate messages.
+        `on_sent(chat_id)` is called once a chat's whole text was delivered,
+        `on_blocked(chat_id)` once a chat turns out to be gone for good.
+        Returns a BroadcastReport once every message has been handled.
+        """
+        report = BroadcastReport()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                try:
+                    if item is None:
+                        return
+                    chat_id, text = item
+                    for chunk in (text,) if isinstance(text, str) else text:
+                        sent = await self._deliver(chat_id, chunk, parse_mode, report)
+                        if not sent:
+                            if sent is False and on_blocked is not None:
+                                on_blocked(chat_id)
+                            break
+                    else:
+                        if on_sent is not None:
+                            on_sent(chat_id)
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        metrics.BROADCAST_ACTIVE.labels().inc()
+        try:
+            if hasattr(messages, "__aiter__"):
+                async for item in messages:
+                    await queue.put(item)
+            else:
+                for item in messages:
+                    await queue.put(item)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for w in workers:
+                w.cancel()
+            self._chat_buckets.clear()
+            metrics.BROADCAST_ACTIVE.labels().dec()
+
+        report.duration = time.monotonic() - report.started
+        return report
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, capacity=1)
+        return bucket
+
+    async def _deliver(self, chat_id, text, parse_mode, report):
+        """Returns True if the message was sent, False if the chat is gone, None if it failed."""
+        for attempt in range(self.max_retries + 1):
+            await self._chat_bucket(chat_id).acquire()
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+                report.sent += 1
+                metrics.BROADCAST_MESSAGES.labels("sent").inc()
+                return True
+            except Forbidden:
+                metrics.BROADCAST_MESSAGES.labels("blocked").inc()
+                report.blocked += 1
+                report.blocked_chats.append(chat_id)
+                return False
+            except RetryAfter as e:
+                wait = _retry_seconds(e)
+                # Flood control applies to the whole bot, so hold every sender
+                self.bucket.pause(wait)
+                delay = wait
+            except BadRequest as e:
+                if any(err in str(e).lower() for err in _DEAD_CHAT_ERRORS):
+                    metrics.BROADCAST_MESSAGES.labels("blocked").inc()
+                    report.blocked += 1
+                    report.blocked_chats.append(chat_id)
+                    return False
+                else:
+                    logging.error(f"Failed to send to {chat_id}: {e}")
+                    metrics.BROADCAST_MESSAGES.labels("failed").inc()
+                    report.failed += 1
+                return
+            except NetworkError as e:
+                delay = self.backoff * (2 ** attempt) * (1 + random.random())
+                logging.warning(f"Transient error sending to {chat_id}: {e}")
+            except Exception as e:
+                logging.error(f"Failed to send to {chat_id}: {e}")
+                metrics.BROADCAST_MESSAGES.labels("failed").inc()
+                report.failed += 1
+                return
+
+            if attempt < self.max_retries:
+                metrics.BROADCAST_MESSAGES.labels("retried").inc()
+                report.retries += 1
+                await asyncio.sleep(delay)
+
+        logging.error(f"Giving up on {chat_id} after {self.max_retries} retries")
+        metrics.BROADCAST_MESSAGES.labels("failed").inc()
+        report.failed += 1
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+
+CACHE_TTL = float(os.getenv("CACHE_TTL", "600"))               # fresh for 10 min
+CACHE_STALE_TTL = float(os.getenv("CACHE_STALE_TTL", "3600"))  # then served stale while refreshing
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "5000"))
+
+
+class _Entry:
+    __slots__ = ("value", "stored_at")
+
+    def __init__(self, value, stored_at):
+        self.value = value
+        self.stored_at = stored_at
+
+
+class AttendanceCache:
+    """
+    Per-chat cache of attendance data.
+
+    - TTL + LRU eviction (at most `max_entries` chats kept)
+    - stale-while-revalidate: entries older than `ttl` but younger than
+      `ttl + stale_ttl` are returned immediately and refreshed in the background
+    - single-flight: concurrent misses for one chat share one loader call
+    - invalidate()/refresh() are called when the worker reports SUCCESS
+    """
+
+    def __init__(self, ttl=CACHE_TTL, stale_ttl=CACHE_STALE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get(self, chat_id, loader):
+        """Returns cached data for chat_id, calling `await loader(chat_id)` when needed."""
+        entry = self._entries.get(chat_id)
+        if entry is not None:
+            age = time.monotonic() - entry.stored_at
+            if age < self.ttl:
+                self.hits += 1
+                self._entries.move_to_end(chat_id)
+                return entry.value
+            if age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self._entries.move_to_end(chat_id)
+                self._start_load(chat_id, loader)
+                return entry.value
+
+        self.misses += 1
+        return await self._wait(chat_id, loader)
+
+    def peek(self, chat_id):
+        """Returns the cached value (fresh or stale) without loading, or None."""
+        entry = self._entries.get(chat_id)
+        return entry.value if entry is not None else None
+
+    def put(self, chat_id, value):
+        self._entries[chat_id] = _Entry(value, time.monotonic())
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def restore(self, chat_id, value):
+        """
+        Seeds an entry as already stale (used at startup): the first read
+        returns it at once and triggers a background refresh.
+        """
+        if chat_id in self._entries:
+            return
+        self._entries[chat_id] = _Entry(value, time.monotonic() - self.ttl)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, chat_id):
+        """Drops the entry and detaches any in-flight load so its result is not stored."""
+        self._entries.pop(chat_id, None)
+        self._inflight.pop(chat_id, None)
+
+    async def refresh(self, chat_id, loader):
+        """Invalidates and reloads immediately; returns the new value."""
+        self.invalidate(chat_id)
+        return await self._wait(chat_id, loader)
+
+    def stats(self):
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+        }
+
+    # ---------- single-flight ----------
+
+    async def _wait(self, chat_id, loader):
+        if chat_id in self._inflight:
+            self.coalesced += 1
+        task = self._start_load(chat_id, loader)
+        # shield: one cancelled waiter must not cancel the shared load
+        return await asyncio.shield(task)
+
+    def _start_load(self, chat_id, loader):
+        task = self._inflight.get(chat_id)
+        if task is None:
+            self.loads += 1
+            task = asyncio.ensure_future(self._load(chat_id, loader))
+            task.add_done_callback(self._log_failure)
+            self._inflight[chat_id] = task
+        return task
+
+    async def _load(self, chat_id, loader):
+        task = asyncio.current_task()
+        try:
+            value = await loader(chat_id)
+            # Only store if nobody invalidated this chat while we were loading
+            if self._inflight.get(chat_id) is task:
+                self.put(chat_id, value)
+            return value
+        finally:
+            if self._inflight.get(chat_id) is task:
+                del self._inflight[chat_id]
+
+    @staticmethod
+    def _log_failure(task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Cache load failed: {task.exception()}")
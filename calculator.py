@@ -0,0 +1,80 @@
+import math
+import os
+from fractions import Fraction
+
+# Thresholds are exact fractions so "can skip" never flips on float rounding
+# (45/50 at 90% is exactly on the line, not 0.8999...).
+
+
+def parse_threshold(text):
+    """
+    '85', '85%', '87.5' or '0.85' -> Fraction in (0, 1]; raises ValueError.
+    A trailing % always means percent ('1%' is 1%, not 100%); a bare number
+    up to 1 is a fraction.
+    """
+    text = str(text).strip()
+    if text.endswith("%"):
+        value = Fraction(text[:-1].strip()) / 100
+    else:
+        value = Fraction(text)
+        if value > 1:
+            value /= 100
+    if not 0 < value <= 1:
+        raise ValueError(f"Threshold must be between 0 and 100%, got {text}")
+    return value
+
+
+def format_threshold(threshold):
+    return f"{float(threshold) * 100:g}%"
+
+
+DEFAULT_THRESHOLD = parse_threshold(os.getenv("ATTENDANCE_THRESHOLD", "85"))
+SAFE_MARGIN = parse_threshold(os.getenv("SAFE_MARGIN", "5"))  # percentage points above the threshold
+
+
+def safe_threshold(threshold):
+    """Level shown as "safe" in summaries: the threshold plus SAFE_MARGIN, capped at 100%."""
+    return min(Fraction(1), threshold + SAFE_MARGIN)
+
+
+def can_skip(conducted, present, threshold):
+    """Most classes that can be missed in a row while staying at or above threshold."""
+    if present < threshold * conducted:
+        return 0
+    return math.floor(present / threshold) - conducted
+
+
+def must_attend(conducted, present, threshold):
+    """Fewest classes to attend in a row to reach threshold; None if it can't be reached."""
+    if present >= threshold * conducted:
+        return 0
+    if threshold == 1:
+        return None
+    return math.ceil((threshold * conducted - present) / (1 - threshold))
+
+
+def what_if(conducted, present, attend=0, skip=0):
+    """(conducted, present) after attending `attend` and skipping `skip` more classes."""
+    return conducted + attend + skip, present + attend
+
+
+class Plan:
+    """Where one subject stands against a threshold."""
+
+    __slots__ = ("row", "pct", "skip", "need")
+
+    def __init__(self, row, pct, skip, need):
+        self.row = row
+        self.pct = pct
+        self.skip = skip    # classes that can still be missed
+        self.need = need    # classes to attend to recover (None = out of reach)
+
+
+def assess(conducted, present, threshold, row=None):
+    pct = present / conducted if conducted else (row.pct if row is not None else 0.0)
+    return Plan(row, pct, can_skip(conducted, present, threshold), must_attend(conducted, present, threshold))
+
+
+def plan(rows, threshold=DEFAULT_THRESHOLD):
+    """Evaluates every subject against one threshold in a single pass."""
+    return [assess(r.conducted, r.present, threshold, r) for r in rows]
@@ -0,0 +1,331 @@
+import datetime
+import logging
+import os
+import time
+
+from models import AttendanceData, Row
+from store import DB_PATH, open_db
+
+# Every KEYFRAME_INTERVAL-th snapshot of a chat is stored in full; the rest
+# only hold per-subject count deltas against the previous snapshot, which
+# are usually a few bytes (0 or 1 new class per subject).
+KEYFRAME_INTERVAL = int(os.getenv("HISTORY_KEYFRAME_INTERVAL", "32"))
+HISTORY_MMAP_SIZE = int(os.getenv("HISTORY_MMAP_SIZE", str(64 * 1024 * 1024)))  # 0 = plain reads
+TERM_END = os.getenv("TERM_END")  # "YYYY-MM-DD"; projections go this far
+PROJECTION_DAYS = int(os.getenv("PROJECTION_DAYS", "30"))  # used when TERM_END is unset
+TREND_WINDOW = 28 * 86400  # recent attendance rate is measured over the last 4 weeks
+
+_KEYFRAME, _DELTA = b"K", b"D"
+
+
+# ---------- encoding ----------
+
+def _put_varint(out, n):
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _get_varint(buf, pos):
+    n = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return n, pos
+        shift += 7
+
+
+def _zigzag(n):
+    # counts can go down when the college corrects a register
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+
+def _unzigzag(n):
+    return n // 2 if not n & 1 else -(n + 1) // 2
+
+
+def encode_keyframe(entries):
+    """entries: [(subject, type, conducted, present)] -> bytes."""
+    out = bytearray(_KEYFRAME)
+    _put_varint(out, len(entries))
+    for subject, kind, conducted, present in entries:
+        for text in (subject, kind):
+            raw = text.encode()
+            _put_varint(out, len(raw))
+            out += raw
+        _put_varint(out, conducted)
+        _put_varint(out, present)
+    return bytes(out)
+
+
+def encode_delta(previous, entries):
+    """Count changes against `previous`, which must list the same subjects in the same order."""
+    out = bytearray(_DELTA)
+    for (_, _, c0, p0), (_, _, c1, p1) in zip(previous, entries):
+        _put_varint(out, _zigzag(c1 - c0))
+        _put_varint(out, _zigzag(p1 - p0))
+    return bytes(out)
+
+
+def decode(payload, previous=None):
+    """Inverse of encode_keyframe/encode_delta; deltas need the previous entries."""
+    if payload[:1] == _KEYFRAME:
+        count, pos = _get_varint(payload, 1)
+        entries = []
+        for _ in range(count):
+            texts = []
+            for _ in range(2):
+                size, pos = _get_varint(payload, pos)
+                texts.append(payload[pos:pos + size].decode())
+                pos += size
+            conducted, pos = _get_varint(payload, pos)
+            present, pos = _get_varint(payload, pos)
+            entries.append((texts[0], texts[1], conducted, present))
+        return tuple(entries)
+    if previous is None:
+        raise ValueError("delta snapshot without a preceding keyframe")
+    pos = 1
+    entries = []
+    for subject, kind, conducted, present in previous:
+        dc, pos = _get_varint(payload, pos)
+        dp, pos = _get_varint(payload, pos)
+        entries.append((subject, kind, conducted + _unzigzag(dc), present + _unzigzag(dp)))
+    return tuple(entries)
+
+
+def entries_of(rows):
+    """The (subject, type, conducted, present) tuples a snapshot stores for `rows`."""
+    return tuple((r.subject, r.type, r.conducted, r.present) for r in rows)
+
+
+def _same_subjects(a, b):
+    return len(a) == len(b) and all(x[:2] == y[:2] for x, y in zip(a, b))
+
+
+# ---------- store ----------
+
+class _Tail:
+    __slots__ = ("taken_at", "entries", "since_keyframe", "checked_at")
+
+    def __init__(self, taken_at, entries, since_keyframe, checked_at=None):
+        self.taken_at = taken_at
+        self.entries = entries
+        self.since_keyframe = since_keyframe
+        self.checked_at = max(taken_at, checked_at or 0.0)  # last scrape that confirmed these entries
+
+
+class HistoryStore:
+    """
+    Append-only attendance snapshots per chat, recorded after each
+    successful worker scrape.
+
+    Rows live in a WITHOUT ROWID table clustered on (chat_id, taken_at), so
+    a chat's history is one contiguous range read. The newest snapshot of
+    each chat seen so far is kept in memory for delta encoding and for
+    latest(), which the daily summary reads instead of calling GAS.
+    """
+
+    def __init__(self, path=DB_PATH, keyframe_interval=KEYFRAME_INTERVAL, mmap_size=HISTORY_MMAP_SIZE):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.mmap_size = mmap_size
+        self.conn = None
+        self._tails = {}   # chat_id -> _Tail, or None when the chat has no history
+        self.recorded = 0
+        self.unchanged = 0
+
+    def open(self):
+        if self.conn is not None:
+            return self
+        self.conn = open_db(self.path)
+        if self.mmap_size:
+            self.conn.execute(f"PRAGMA mmap_size={self.mmap_size}")
+        return self
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _tail(self, chat_id):
+        if chat_id not in self._tails:
+            last = None
+            for taken_at, entries, since_keyframe in self._replay(chat_id, since=float("inf")):
+                last = _Tail(taken_at, entries, since_keyframe)
+            if last is not None:
+                row = self.conn.execute("SELECT checked_at FROM history_checks WHERE chat_id = ?", (chat_id,)).fetchone()
+                last.checked_at = max(last.checked_at, row[0] if row else 0.0)
+            self._tails[chat_id] = last
+        return self._tails[chat_id]
+
+    def _replay(self, chat_id, since=None, until=None):
+        """
+        Decodes snapshots from the last keyframe at or before `since` (the
+        first keyframe if None) up to `until`; yields (taken_at, entries,
+        deltas since keyframe).
+        """
+        start = self.conn.execute(
+            "SELECT MAX(taken_at) FROM snapshots WHERE chat_id = ? AND keyframe = 1 AND taken_at <= ?",
+            (chat_id, since if since is not None else float("-inf")),
+        ).fetchone()[0]
+        if start is None:
+            start = float("-inf")
+        cursor = self.conn.execute(
+            "SELECT taken_at, payload FROM snapshots WHERE chat_id = ? AND taken_at >= ? AND taken_at <= ? "
+            "ORDER BY taken_at",
+            (chat_id, start, until if until is not None else float("inf")),
+        )
+        entries = None
+        since_keyframe = 0
+        for taken_at, payload in cursor:
+            if entries is None and payload[:1] != _KEYFRAME:
+                continue
+            since_keyframe = 0 if payload[:1] == _KEYFRAME else since_keyframe + 1
+            entries = decode(payload, entries)
+            yield taken_at, entries, since_keyframe
+
+    def record(self, chat_id, data, taken_at=None):
+        """
+        Appends a snapshot of `data` (AttendanceData); returns False if nothing
+        changed, in which case only the time it was last checked moves on.
+        """
+        chat_id = str(chat_id)
+        entries = entries_of(data.rows)
+        if not entries:
+            return False
+        taken_at = taken_at if taken_at is not None else time.time()
+        tail = self._tail(chat_id)
+        if tail is not None and tail.entries == entries:
+            self.unchanged += 1
+            if taken_at > tail.checked_at:
+                tail.checked_at = taken_at
+                with self.conn:
+                    self.conn.execute(
+                        "INSERT INTO history_checks (chat_id, checked_at) VALUES (?, ?) "
+                        "ON CONFLICT (chat_id) DO UPDATE SET checked_at = excluded.checked_at",
+                        (chat_id, taken_at),
+                    )
+            return False
+
+        if tail is not None:
+            taken_at = max(taken_at, tail.taken_at + 1e-3)  # keeps the primary key increasing
+        keyframe = (
+            tail is None
+            or not _same_subjects(tail.entries, entries)
+            or tail.since_keyframe + 1 >= self.keyframe_interval
+        )
+        payload = encode_keyframe(entries) if keyframe else encode_delta(tail.entries, entries)
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO snapshots (chat_id, taken_at, keyframe, payload) VALUES (?, ?, ?, ?)",
+                (chat_id, taken_at, int(keyframe), payload),
+            )
+        self._tails[chat_id] = _Tail(taken_at, entries, 0 if keyframe else tail.since_keyframe + 1)
+        self.recorded += 1
+        return True
+
+    def forget(self, chat_ids):
+        """Drops cached tails so the next read goes to disk (another process may have recorded since)."""
+        for chat_id in chat_ids:
+            self._tails.pop(str(chat_id), None)
+
+    def latest(self, chat_id):
+        """Newest snapshot as AttendanceData (fetched_at = when a scrape last confirmed it), or None."""
+        tail = self._tail(str(chat_id))
+        if tail is None:
+            return None
+        return AttendanceData(
+            [Row(s, k, c, p, p / c if c else 0.0) for s, k, c, p in tail.entries],
+            fetched_at=tail.checked_at,
+        )
+
+    def recent_chats(self, limit):
+        """chat_ids with history, most recently scraped first."""
+        return [chat_id for (chat_id,) in self.conn.execute(
+            "SELECT chat_id FROM (SELECT chat_id, MAX(taken_at) AS at FROM snapshots GROUP BY chat_id "
+            "UNION ALL SELECT chat_id, checked_at FROM history_checks) "
+            "GROUP BY chat_id ORDER BY MAX(at) DESC LIMIT ?", (limit,)
+        )]
+
+    def range(self, chat_id, since=None, until=None):
+        """[(taken_at, ((subject, type, conducted, present), ...))] between since and until."""
+        return [
+            (taken_at, entries)
+            for taken_at, entries, _ in self._replay(str(chat_id), since, until)
+            if since is None or taken_at >= since
+        ]
+
+    def stats(self):
+        count, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM snapshots").fetchone()
+        return {"snapshots": count, "bytes": size, "recorded": self.recorded, "unchanged": self.unchanged}
+
+
+# ---------- trends ----------
+
+def subject_series(snapshots, subject, kind):
+    """[(taken_at, conducted, present)] for one subject out of range() results."""
+    series = []
+    for taken_at, entries in snapshots:
+        for s, k, conducted, present in entries:
+            if s == subject and k == kind:
+                series.append((taken_at, conducted, present))
+                break
+    return series
+
+
+def _pct(conducted, present):
+    return present / conducted if conducted else 0.0
+
+
+def change_since(series, seconds, now=None):
+    """Percentage-point change from the last point at least `seconds` old to the newest; None without a baseline."""
+    if len(series) < 2:
+        return None
+    cutoff = (now if now is not None else time.time()) - seconds
+    baseline = series[0]
+    for point in series:
+        if point[0] > cutoff:
+            break
+        baseline = point
+    if baseline is series[-1]:
+        return None
+    return _pct(*series[-1][1:]) - _pct(*baseline[1:])
+
+
+def term_end(now=None):
+    """Timestamp the projection runs to: TERM_END, else PROJECTION_DAYS from now."""
+    now = now if now is not None else time.time()
+    if TERM_END:
+        try:
+            end = datetime.datetime.strptime(TERM_END, "%Y-%m-%d").timestamp()
+            if end > now:
+                return end
+        except ValueError:
+            logging.warning(f"Ignoring invalid TERM_END {TERM_END!r}; expected YYYY-MM-DD")
+    return now + PROJECTION_DAYS * 86400
+
+
+def project(series, until, window=TREND_WINDOW):
+    """
+    Percentage at `until` if classes keep being held and attended at the
+    rate seen over the last `window` seconds; None if there isn't enough history.
+    """
+    if len(series) < 2:
+        return None
+    last_at, conducted, present = series[-1]
+    first = next(p for p in series if p[0] >= last_at - window)
+    elapsed = last_at - first[0]
+    held = conducted - first[1]
+    if elapsed < 86400 or held <= 0:
+        return None
+    ahead = max(0.0, until - last_at)
+    future_held = held / elapsed * ahead
+    future_attended = (present - first[2]) / elapsed * ahead
+    return _pct(conducted + future_held, present + future_attended)
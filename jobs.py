@@ -0,0 +1,314 @@
+import collections
+import logging
+import os
+import time
+import uuid
+
+from admission import FairQueue
+from workers import WorkerPool
+
+# Wire format between this bot and the worker bot (in COMMUNICATION_GROUP_ID):
+#   REQ_SCRAPE  v1 <job_id> <chat_id> [<worker_id>]
+#   CAPTCHA_REQ v1 <job_id> <chat_id>            (photo caption)
+#   CAPTCHA_SOL v1 <job_id> <chat_id> <text>
+#   SUCCESS     v1 <job_id> <chat_id>
+#   FAIL        v1 <job_id> <chat_id> <reason>
+#   HELLO       v1 <worker_id> [<capacity>]     (worker start-up)
+#   HEARTBEAT   v1 <worker_id> [<capacity>]     (periodically, well inside WORKER_HEARTBEAT_TIMEOUT)
+# Once any worker has said HELLO, requests carry the worker_id they are
+# addressed to and other workers must ignore them.
+# Legacy workers omit "v1 <job_id>"; incoming legacy messages are still accepted
+# and WORKER_PROTOCOL=legacy makes outgoing messages use the old format.
+PROTOCOL_VERSION = "v1"
+WORKER_PROTOCOL = os.getenv("WORKER_PROTOCOL", PROTOCOL_VERSION)
+MAX_INFLIGHT_SCRAPES = int(os.getenv("MAX_INFLIGHT_SCRAPES", "1"))
+
+REQ_SCRAPE, CAPTCHA_REQ, CAPTCHA_SOL, SUCCESS, FAIL = "REQ_SCRAPE", "CAPTCHA_REQ", "CAPTCHA_SOL", "SUCCESS", "FAIL"
+WORKER_REPLIES = (CAPTCHA_REQ, SUCCESS, FAIL)
+HELLO, HEARTBEAT = "HELLO", "HEARTBEAT"
+WORKER_CONTROL = (HELLO, HEARTBEAT)
+RETIRED_JOB_IDS = 1000  # reassigned job_ids remembered so late replies are dropped
+
+# Job states
+QUEUED, STARTED, CAPTCHA, SOLVING, DONE, FAILED = "queued", "started", "captcha", "solving", "done", "failed"
+ACTIVE_STATES = (QUEUED, STARTED, CAPTCHA, SOLVING)
+
+# Seconds a job may sit in each state before it is failed
+STATE_TIMEOUTS = {
+    QUEUED: float(os.getenv("JOB_QUEUED_TIMEOUT", "900")),
+    STARTED: float(os.getenv("JOB_STARTED_TIMEOUT", "120")),
+    CAPTCHA: float(os.getenv("JOB_CAPTCHA_TIMEOUT", "300")),
+    SOLVING: float(os.getenv("JOB_SOLVING_TIMEOUT", "180")),
+}
+
+
+class WorkerMessage:
+    __slots__ = ("kind", "job_id", "chat_id", "rest")
+
+    def __init__(self, kind, job_id, chat_id, rest):
+        self.kind = kind
+        self.job_id = job_id
+        self.chat_id = chat_id
+        self.rest = rest
+
+
+def format_message(kind, job_id, chat_id, *extra):
+    if WORKER_PROTOCOL == PROTOCOL_VERSION:
+        parts = [kind, PROTOCOL_VERSION, job_id, str(chat_id), *extra]
+    else:
+        parts = [kind, str(chat_id), *extra]
+    return " ".join(parts)
+
+
+def parse_message(text):
+    """
+    Parses a worker reply; returns WorkerMessage or None.
+    The kind must be the first token, so a FAIL reason that happens to
+    contain "SUCCESS" can't be misrouted.
+    """
+    parts = (text or "").split()
+    if not parts or parts[0] not in WORKER_REPLIES:
+        return None
+    if len(parts) >= 4 and parts[1] == PROTOCOL_VERSION:
+        return WorkerMessage(parts[0], parts[2], parts[3], " ".join(parts[4:]))
+    if len(parts) >= 2:
+        return WorkerMessage(parts[0], None, parts[1], " ".join(parts[2:]))
+    return None
+
+
+def parse_control(text):
+    """Parses HELLO/HEARTBEAT; returns (kind, worker_id, capacity or None) or None."""
+    parts = (text or "").split()
+    if len(parts) < 3 or parts[0] not in WORKER_CONTROL or parts[1] != PROTOCOL_VERSION:
+        return None
+    capacity = None
+    if len(parts) >= 4:
+        try:
+            capacity = max(1, int(parts[3]))
+        except ValueError:
+            pass
+    return parts[0], parts[2], capacity
+
+
+class Job:
+    __slots__ = ("job_id", "chat_id", "state", "created", "state_since", "reason", "worker_id")
+
+    def __init__(self, chat_id):
+        self.job_id = uuid.uuid4().hex[:10]
+        self.chat_id = str(chat_id)
+        self.state = QUEUED
+        self.created = time.monotonic()
+        self.state_since = self.created
+        self.reason = ""
+        self.worker_id = None   # set when handed to a pooled worker
+
+    @property
+    def active(self):
+        return self.state in ACTIVE_STATES
+
+    def move(self, state, reason=""):
+        self.state = state
+        self.state_since = time.monotonic()
+        self.reason = reason
+
+
+class JobTracker:
+    """
+    Tracks worker scrapes: one active job per chat (duplicate /update taps
+    reuse it) and a fair queue for jobs waiting for a worker, so chats that
+    scrape often wait behind those that don't. sweep() fails jobs stuck in
+    a state too long.
+
+    With a worker pool (workers that sent HELLO) each job goes to the
+    least-loaded healthy worker and jobs held by a worker that stops
+    heartbeating are requeued at the front under a new job_id. Without one,
+    at most `max_inflight` unaddressed requests go to the single legacy worker.
+
+    `send(text)` posts to the worker group; `notify(chat_id, text)` messages
+    the user. Both are coroutines supplied by the bot.
+    """
+
+    def __init__(self, send=None, notify=None, max_inflight=MAX_INFLIGHT_SCRAPES, timeouts=STATE_TIMEOUTS,
+                 pool=None):
+        self.send = send
+        self.notify = notify
+        self.max_inflight = max_inflight
+        self.timeouts = timeouts
+        self.pool = pool if pool is not None else WorkerPool()
+        self.jobs = {}          # job_id -> Job (active jobs only)
+        self.by_chat = {}       # chat_id -> Job
+        self.queue = FairQueue()
+        self.inflight = set()   # job_ids handed to the worker
+        self.on_finish = None   # optional callback(job) for terminal states
+        self.on_reassign = None  # optional callback(job, old_job_id) when a job moves to another worker
+        self.retired = collections.deque(maxlen=RETIRED_JOB_IDS)
+        self.reassigned = 0
+
+    def active(self, chat_id):
+        return self.by_chat.get(str(chat_id))
+
+    def position(self, job):
+        """1-based queue position, or 0 once the job has been handed to the worker."""
+        return self.queue.position(job.job_id)
+
+    async def submit(self, chat_id, weight=1.0):
+        """
+        Returns (job, created). An existing active job for the chat is reused.
+        A higher `weight` gives the chat a larger share of workers under contention.
+        """
+        existing = self.active(chat_id)
+        if existing:
+            return existing, False
+        job = Job(chat_id)
+        self.jobs[job.job_id] = job
+        self.by_chat[job.chat_id] = job
+        self.queue.push(job.job_id, job.chat_id, weight=weight)
+        await self._pump(submitted=job)
+        return job, True
+
+    async def _pump(self, submitted=None):
+        while self.queue:
+            if self.pool:
+                worker = self.pool.pick()
+                if worker is None:
+                    break
+            elif len(self.inflight) < self.max_inflight:
+                worker = None
+            else:
+                break
+            job = self.jobs.get(self.queue.pop())
+            if job is None:
+                continue
+            self.inflight.add(job.job_id)
+            job.move(STARTED)
+            extra = ()
+            if worker is not None:
+                job.worker_id = worker.worker_id
+                self.pool.assign(worker, job.job_id)
+                extra = (worker.worker_id,)
+            try:
+                await self.send(format_message(REQ_SCRAPE, job.job_id, job.chat_id, *extra))
+            except Exception as e:
+                logging.error(f"Failed to dispatch job {job.job_id}: {e}")
+                await self._finish(job, FAILED, f"could not reach worker ({e})", notify=job is not submitted)
+                continue
+            if job is not submitted:
+                # It waited in the queue; the submitter already got its position
+                try:
+                    await self.notify(job.chat_id, "📡 Your update has started. Wait for CAPTCHA...")
+                except Exception as e:
+                    logging.error(f"Failed to notify {job.chat_id}: {e}")
+
+    def resolve(self, msg):
+        """Finds the job a worker reply belongs to (by job_id, or by chat for legacy replies)."""
+        job = self.jobs.get(msg.job_id) if msg.job_id else self.active(msg.chat_id)
+        if job is not None and job.worker_id:
+            self.pool.touch(job.worker_id)
+        return job
+
+    def is_retired(self, job_id):
+        """True for job_ids taken away from a silent worker; their late replies are stale."""
+        return job_id is not None and job_id in self.retired
+
+    async def worker_message(self, kind, worker_id, capacity=None):
+        """Handles HELLO/HEARTBEAT: updates the pool and dispatches onto any new capacity."""
+        if kind == HELLO:
+            orphaned = self.pool.announce(worker_id, capacity)
+        else:
+            orphaned = self.pool.heartbeat(worker_id, capacity)
+        # A worker that says HELLO again has restarted and lost what it was doing
+        for job_id in orphaned:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                await self._reassign(job)
+        await self._pump()
+
+    async def _reassign(self, job):
+        old_job_id = job.job_id
+        self.retired.append(old_job_id)
+        self.inflight.discard(old_job_id)
+        del self.jobs[old_job_id]
+        job.job_id = uuid.uuid4().hex[:10]
+        job.worker_id = None
+        job.move(QUEUED)
+        self.jobs[job.job_id] = job
+        self.queue.push_front(job.job_id)
+        self.reassigned += 1
+        logging.warning(f"Job {old_job_id} for {job.chat_id} requeued as {job.job_id}")
+        if self.on_reassign:
+            self.on_reassign(job, old_job_id)
+        try:
+            await self.notify(
+                job.chat_id, "🔁 The worker handling your update went offline. Retrying on another worker..."
+            )
+        except Exception as e:
+            logging.error(f"Failed to notify {job.chat_id}: {e}")
+
+    async def captcha_requested(self, msg):
+        job = self.resolve(msg)
+        if job:
+            job.move(CAPTCHA)
+        return job
+
+    def captcha_solution(self, chat_id, text, job_id=None):
+        """
+        Marks the chat's job as solving and returns the CAPTCHA_SOL message for the worker.
+        `job_id` is used when the job is unknown here (e.g. issued before a restart).
+        """
+        job = self.active(chat_id)
+        if job is None:
+            return format_message(CAPTCHA_SOL, job_id or "-", chat_id, text)
+        job.move(SOLVING)
+        return format_message(CAPTCHA_SOL, job.job_id, chat_id, text)
+
+    async def succeeded(self, msg):
+        job = self.resolve(msg)
+        if job:
+            await self._finish(job, DONE)
+        return job
+
+    async def failed(self, msg):
+        job = self.resolve(msg)
+        if job:
+            await self._finish(job, FAILED, msg.rest)
+        return job
+
+    async def _finish(self, job, state, reason="", notify=False):
+        job.move(state, reason)
+        self.jobs.pop(job.job_id, None)
+        if self.by_chat.get(job.chat_id) is job:
+            del self.by_chat[job.chat_id]
+        self.inflight.discard(job.job_id)
+        if job.worker_id:
+            self.pool.release(job.worker_id, job.job_id)
+        self.queue.remove(job.job_id)
+        if self.on_finish:
+            self.on_finish(job)
+        if notify:
+            try:
+                await self.notify(job.chat_id, f"❌ Update Failed: {reason}")
+            except Exception as e:
+                logging.error(f"Failed to report failure to {job.chat_id}: {e}")
+        await self._pump()
+
+    async def sweep(self):
+        """Requeues jobs of workers that went silent, then fails jobs that exceeded their per-state timeout."""
+        orphaned = self.pool.sweep()
+        for job_id in orphaned:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                await self._reassign(job)
+        if orphaned:
+            await self._pump()
+        now = time.monotonic()
+        expired = [(j, j.state) for j in self.jobs.values()
+                   if now - j.state_since > self.timeouts.get(j.state, float("inf"))]
+        for job, state in expired:
+            if self.jobs.get(job.job_id) is not job or job.state != state:
+                continue  # each _finish() pumps the queue, which may have started this job meanwhile
+            logging.warning(f"Job {job.job_id} for {job.chat_id} timed out in state {job.state}")
+            await self._finish(job, FAILED, f"timed out while {job.state}", notify=True)
+
+    def stats(self):
+        counts = collections.Counter(j.state for j in self.jobs.values())
+        return {"queued": len(self.queue), "inflight": len(self.inflight), "reassigned": self.reassigned, **counts}
@@ -0,0 +1,225 @@
+import asyncio
+import bisect
+import functools
+import logging
+import os
+import time
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))   # 0 = no HTTP endpoint
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "0.0.0.0")
+
+# Latency buckets in seconds, from cache hits up to GAS timeouts
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30)
+
+REGISTRY = []
+STARTED = time.time()
+
+
+class _Child:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation (coarse, for /stats)."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._function = None
+        REGISTRY.append(self)
+
+    def _new_child(self):
+        return _Child()
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def set_function(self, fn):
+        """Computes {label values tuple: value} at scrape time instead of storing values."""
+        self._function = fn
+        return self
+
+    def samples(self):
+        if self._function is not None:
+            return [(tuple(str(v) for v in k), v) for k, v in self._function().items()]
+        return [(k, c.value) for k, c in self._children.items()]
+
+    def _labels(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ""
+        body = ",".join(f'{k}="{_escape(v)}"' for k, v in pairs)
+        return "{" + body + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, value in self.samples():
+            lines.append(f"{self.name}{self._labels(values)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, child.counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{self._labels(values, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{self._labels(values, [('le', '+Inf')])} {child.count}")
+            lines.append(f"{self.name}_sum{self._labels(values)} {child.sum}")
+            lines.append(f"{self.name}_count{self._labels(values)} {child.count}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            logging.error(f"Failed to collect metric {metric.name}: {e}")
+    return "\n".join(lines) + "\n"
+
+
+# ---------- bot metrics ----------
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Handler latency", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Handlers that raised", ("handler",))
+SHEETS_SECONDS = Histogram("bot_sheets_request_seconds", "Apps Script request latency", ("op", "result"))
+SHEETS_RETRIES = Counter("bot_sheets_retries_total", "Apps Script reads retried", ("op",))
+SHEETS_SHORT_CIRCUITS = Counter("bot_sheets_short_circuits_total", "Calls refused by the open breaker", ("op",))
+SHEETS_BREAKER = Gauge("bot_sheets_breaker_open", "1 while the Sheets circuit breaker is open or half-open")
+TELEGRAM_SECONDS = Histogram("bot_telegram_request_seconds", "Bot API call latency", ("method", "result"))
+BROADCAST_MESSAGES = Counter("bot_broadcast_messages_total", "Broadcast deliveries", ("result",))
+BROADCAST_ACTIVE = Gauge("bot_broadcast_active", "Broadcasts currently running")
+JOB_STATES = Gauge("bot_worker_jobs", "Worker scrape jobs by state", ("state",))
+JOBS_FINISHED = Counter("bot_worker_jobs_finished_total", "Finished worker scrape jobs", ("state",))
+WORKERS = Gauge("bot_worker_pool", "Pooled worker bots and their job slots", ("stat",))
+ADMISSION_REJECTED = Counter("bot_admission_rejected_total", "Requests refused by per-chat budgets", ("kind",))
+CACHE = Gauge("bot_cache", "Attendance cache counters", ("stat",))
+RENDER_CACHE = Gauge("bot_render_cache", "Rendered message cache counters", ("stat",))
+CAPTCHA = Gauge("bot_captcha", "CAPTCHA wait counters and round-trip latency", ("stat",))
+SUBSCRIBERS = Gauge("bot_alert_subscribers", "Chats with daily alerts enabled")
+READY_SECONDS = Gauge("bot_ready_seconds", "Seconds from process start to serving updates")
+UPTIME = Gauge("bot_uptime_seconds", "Seconds since start").set_function(lambda: {(): time.time() - STARTED})
+
+
+def instrumented(name):
+    """
+    Decorator for handlers: records latency and errors under `name`.
+    `name` may be a function of the update (e.g. to label button_handler by callback data).
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(update, context, *args, **kwargs):
+            label = name(update) if callable(name) else name
+            t = time.perf_counter()
+            try:
+                return await fn(update, context, *args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.labels(label).inc()
+                raise
+            finally:
+                HANDLER_SECONDS.labels(label).observe(time.perf_counter() - t)
+        return wrapper
+    return decorator
+
+
+# ---------- HTTP endpoint ----------
+
+async def _handle(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        # drain headers
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass
+        path = request.split()[1].decode() if len(request.split()) > 1 else "/"
+        if path.split("?")[0] == "/metrics":
+            body, status = render().encode(), "200 OK"
+        else:
+            body, status = b"not found\n", "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logging.error(f"Metrics request failed: {e}")
+    finally:
+        writer.close()
+
+
+async def start_server(port=METRICS_PORT, host=METRICS_LISTEN):
+    """Serves GET /metrics in Prometheus text format; returns the server (or None if disabled)."""
+    if not port:
+        return None
+    server = await asyncio.start_server(_handle, host, port)
+    logging.info(f"Metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,96 @@
+import logging
+import math
+import time
+
+from subjects import SubjectIndex
+
+
+class Row:
+    """One subject row from the attendance sheet, parsed once per fetch."""
+
+    __slots__ = ("subject", "type", "conducted", "present", "pct", "status", "bunk")
+
+    def __init__(self, subject, type, conducted, present, pct, status="", bunk=""):
+        self.subject = subject
+        self.type = type
+        self.conducted = conducted
+        self.present = present
+        self.pct = pct
+        self.status = status
+        self.bunk = bunk
+
+    def __repr__(self):
+        return f"Row({self.subject!r}, {self.type!r}, {self.conducted}, {self.present}, {self.pct:.3f})"
+
+
+class AttendanceData:
+    """Parsed rows for one chat plus when they were fetched; this is what the cache holds."""
+
+    __slots__ = ("rows", "fetched_at", "_index")
+
+    def __init__(self, rows=(), fetched_at=None):
+        self.rows = tuple(rows)
+        self.fetched_at = fetched_at if fetched_at is not None else time.time()
+        self._index = None
+
+    @property
+    def index(self):
+        """SubjectIndex over these rows, built on first lookup and kept with the cached data."""
+        if self._index is None:
+            self._index = SubjectIndex(self.rows)
+        return self._index
+
+
+def _number(value):
+    if isinstance(value, str):
+        value = value.strip().rstrip("%")
+    number = float(value)
+    # int() of inf raises OverflowError and NaN compares false everywhere; both are just bad cells
+    if not math.isfinite(number):
+        raise ValueError(f"not a finite number: {value!r}")
+    return number
+
+
+def _pct(value):
+    # GAS sends a fraction (0.86) but a formatted "86%" cell sometimes slips through
+    if isinstance(value, str) and value.strip().endswith("%"):
+        return _number(value) / 100
+    return _number(value)
+
+
+def parse_row(raw):
+    """Sheet layout: subject, type, conducted, present, pct, status, bunk text."""
+    if not isinstance(raw, (list, tuple)) or len(raw) < 5 or raw[0] is None or not str(raw[0]).strip():
+        raise ValueError(f"expected at least 5 columns, got {raw!r}")
+    conducted = int(_number(raw[2]))
+    present = int(_number(raw[3]))
+    return Row(
+        subject=str(raw[0]).strip(),
+        type=str(raw[1]).strip(),
+        conducted=conducted,
+        present=present,
+        pct=_pct(raw[4]),
+        status=str(raw[5]) if len(raw) > 5 else "",
+        bunk=str(raw[6]) if len(raw) > 6 else "",
+    )
+
+
+def parse_rows(payload, chat_id=None):
+    """
+    Turns an Apps Script payload into AttendanceData.
+    Malformed rows are skipped and reported in a single log line.
+    """
+    if not isinstance(payload, list):
+        # GAS answers {"status": "error", ...} for unknown chats
+        return AttendanceData()
+
+    rows = []
+    bad = []
+    for raw in payload:
+        try:
+            rows.append(parse_row(raw))
+        except (ValueError, TypeError) as e:
+            bad.append(str(e))
+    if bad:
+        logging.warning(f"Skipped {len(bad)} malformed row(s) for chat {chat_id}: {bad[0]}")
+    return AttendanceData(rows)
@@ -0,0 +1,130 @@
+import html
+import os
+import re
+import string
+from collections import OrderedDict
+
+TELEGRAM_LIMIT = 4096  # characters per message
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "2000"))  # rendered views kept
+
+HTML, MARKDOWN_V2 = "HTML", "MarkdownV2"
+
+_MARKDOWN_V2_SPECIAL = re.compile(r"([_*\[\]()~`>#+\-=|{}.!\\])")
+
+
+def escape_html(text):
+    return html.escape(str(text), quote=False)
+
+
+def escape_markdown_v2(text):
+    return _MARKDOWN_V2_SPECIAL.sub(r"\\\1", str(text))
+
+
+ESCAPERS = {HTML: escape_html, MARKDOWN_V2: escape_markdown_v2, None: str}
+
+
+class Template:
+    """
+    A str.format-style template, parsed once at import time.
+
+    Literal text is trusted markup for `parse_mode`; every substituted field
+    is escaped for it, so a subject called "Lab_2 <A&B>" can't break the
+    message. Fields may use attribute access and format specs:
+    "{r.subject}: {r.pct:.1%}". Keep each tag on one line so split_message()
+    never has to cut through one.
+    """
+
+    __slots__ = ("source", "parse_mode", "_parts")
+
+    def __init__(self, source, parse_mode=HTML):
+        self.source = source
+        self.parse_mode = parse_mode
+        self._parts = []
+        for literal, field, spec, conversion in string.Formatter().parse(source):
+            if conversion or (field is not None and ("[" in field or not field)):
+                raise ValueError(f"Unsupported template field {{{field}}} in {source!r}")
+            path = field.split(".") if field is not None else None
+            self._parts.append((literal, path, spec))
+
+    def __call__(self, **fields):
+        escape = ESCAPERS[self.parse_mode]
+        out = []
+        for literal, path, spec in self._parts:
+            out.append(literal)
+            if path is not None:
+                value = fields[path[0]]
+                for attr in path[1:]:
+                    value = getattr(value, attr)
+                out.append(escape(format(value, spec)))
+        return "".join(out)
+
+
+def _cut(text, limit):
+    """Hard cut at `limit` that doesn't split an HTML entity or a MarkdownV2 escape."""
+    cut = limit
+    amp = text.rfind("&", max(0, cut - 10), cut)
+    if amp != -1 and text.find(";", amp, cut) == -1:
+        cut = amp
+    while cut > 1 and text[cut - 1] == "\\":
+        cut -= 1
+    return cut or limit
+
+
+def split_message(text, limit=TELEGRAM_LIMIT):
+    """
+    Splits text into chunks of at most `limit` characters, preferring
+    paragraph breaks, then line breaks; a single longer line is cut hard.
+    """
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = _cut(text, limit)
+            chunks.append(text[:cut])
+            text = text[cut:]
+        else:
+            chunks.append(text[:cut])
+            text = text[cut:].lstrip("\n")
+    if text or not chunks:
+        chunks.append(text)
+    return chunks
+
+
+class RenderCache:
+    """
+    LRU of rendered message bodies keyed by (chat, data version, view), so
+    repeated menu taps, inline queries and the daily broadcast reuse text
+    built from the same attendance data. `view` must capture everything else
+    the text depends on (e.g. the threshold); a new fetch is a new version.
+    """
+
+    def __init__(self, max_entries=RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id, version, view, build):
+        """Returns the rendered text, calling `build()` on a miss."""
+        key = (str(chat_id), version, view)
+        text = self._entries.get(key)
+        if text is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return text
+        self.misses += 1
+        text = self._entries[key] = build()
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return text
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
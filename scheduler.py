@@ -0,0 +1,112 @@
+import datetime
+import hashlib
+import logging
+import os
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+DEFAULT_DELIVERY_TIME = os.getenv("DEFAULT_DELIVERY_TIME", "09:00")
+DELIVERY_WINDOW = int(os.getenv("DELIVERY_WINDOW", "1800"))       # spread deliveries over 30 min
+MISFIRE_GRACE = int(os.getenv("MISFIRE_GRACE", str(6 * 3600)))   # catch up runs missed by < 6h
+SCHEDULER_TICK = int(os.getenv("SCHEDULER_TICK", "60"))
+
+
+def _local_tz_name():
+    try:
+        from tzlocal import get_localzone_name
+        return get_localzone_name() or "UTC"
+    except Exception:
+        return "UTC"
+
+
+DEFAULT_TZ = os.getenv("DEFAULT_TZ") or _local_tz_name()
+
+
+def parse_time(text):
+    """"7:30" / "07:30" -> "07:30"; raises ValueError otherwise."""
+    hour, _, minute = text.strip().partition(":")
+    t = datetime.time(int(hour), int(minute or 0))
+    return t.strftime("%H:%M")
+
+
+def resolve_tz(name):
+    """Returns a ZoneInfo for an IANA name ("Asia/Kolkata"); raises ValueError if unknown."""
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown timezone: {name}")
+
+
+class DeliveryPlanner:
+    """
+    Decides which subscribers are due for their daily summary.
+
+    Each chat's delivery lands at its local delivery time plus an offset in
+    [0, window) derived from (chat_id, date), so deliveries are spread out
+    and shift a little from day to day instead of all firing at 9:00.
+    A run missed by less than `grace` seconds (e.g. across a restart) is
+    delivered once; `last_delivered` prevents duplicates.
+    """
+
+    def __init__(self, window=DELIVERY_WINDOW, grace=MISFIRE_GRACE,
+                 default_tz=DEFAULT_TZ, default_time=DEFAULT_DELIVERY_TIME):
+        self.window = window
+        self.grace = grace
+        self.default_tz = default_tz
+        self.default_time = default_time
+        self._zones = {}
+
+    def zone(self, name):
+        name = name or self.default_tz
+        zone = self._zones.get(name)
+        if zone is None:
+            try:
+                zone = resolve_tz(name)
+            except ValueError:
+                logging.error(f"Unknown timezone {name}, using {self.default_tz}")
+                zone = resolve_tz(self.default_tz)
+            self._zones[name] = zone
+        return zone
+
+    def offset(self, chat_id, day):
+        if self.window <= 0:
+            return 0
+        digest = hashlib.blake2b(f"{chat_id}:{day}".encode(), digest_size=4).digest()
+        return int.from_bytes(digest, "big") % self.window
+
+    def due_at(self, sub, day):
+        """Scheduled delivery for `sub` on local date `day` (aware datetime)."""
+        hour, minute = map(int, (sub.delivery_time or self.default_time).split(":"))
+        base = datetime.datetime.combine(day, datetime.time(hour, minute), tzinfo=self.zone(sub.tz))
+        return base + datetime.timedelta(seconds=self.offset(sub.chat_id, day.isoformat()))
+
+    def due(self, subs, now=None):
+        """Returns [(chat_id, local_date_iso)] for subscriptions whose delivery is due now."""
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        local_now = {}
+        due = []
+        for sub in subs:
+            tz = sub.tz or self.default_tz
+            if tz not in local_now:
+                local_now[tz] = now.astimezone(self.zone(tz))
+            today = local_now[tz].date()
+            # yesterday too: a late delivery time plus its offset can run past midnight
+            for day in (today - datetime.timedelta(days=1), today):
+                if sub.last_delivered and sub.last_delivered >= day.isoformat():
+                    continue
+                lateness = (now - self.due_at(sub, day)).total_seconds()
+                if 0 <= lateness <= self.grace:
+                    due.append((sub.chat_id, day.isoformat()))
+                    break
+        return due
+
+    def last_passed(self, sub, now=None):
+        """Local date (ISO) of the newest slot already behind us, or None."""
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        today = now.astimezone(self.zone(sub.tz)).date()
+        for day in (today, today - datetime.timedelta(days=1)):
+            if self.due_at(sub, day) <= now:
+                return day.isoformat()
+        return None
+
+    def describe(self, sub):
+        return f"{sub.delivery_time or self.default_time} {sub.tz or self.default_tz}"
@@ -0,0 +1,110 @@
+import asyncio
+import os
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+from telegram.request import HTTPXRequest
+
+import metrics
+
+# Webhook mode is used when WEBHOOK_URL is set (e.g. https://my-bot.herokuapp.com);
+# otherwise the bot falls back to long polling for local runs.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or os.getenv("PORT") or "8443")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # checked against X-Telegram-Bot-Api-Secret-Token
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+_UNBOUNDED = 1 << 30  # for PTB's semaphore; see ChatOrderedUpdateProcessor
+
+
+def update_key(update):
+    """Ordering key: the chat, else the user (inline queries), else None (unordered)."""
+    if isinstance(update, Update):
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return f"user:{update.effective_user.id}"
+    return None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates from different chats concurrently while keeping
+    updates from the same chat in arrival order, so the /login
+    ConversationHandler and CAPTCHA replies see messages one at a time.
+
+    An update waits for its chat's turn before taking one of the
+    max_concurrent_updates slots, so a backlog in one busy chat (button
+    mashing, the communication group) never holds slots other chats need.
+    PTB takes its own semaphore before do_process_update(), so that one is
+    sized out of the way and the limit is enforced here instead.
+    `key(update)` picks the ordering key (None = unordered); update_key by default.
+    """
+
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES, key=update_key):
+        super().__init__(_UNBOUNDED)
+        self.key = key
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks = {}
+        self._waiting = {}
+
+    async def do_process_update(self, update, coroutine):
+        key = self.key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        try:
+            async with lock:
+                async with self._slots:
+                    await coroutine
+        finally:
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                # last user of this chat's lock: drop it so the map doesn't grow forever
+                del self._waiting[key]
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records each Bot API call's latency by method and outcome."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        t = time.perf_counter()
+        result = "exception"
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+            result = "ok" if status < 400 else str(status)
+            return status, payload
+        finally:
+            metrics.TELEGRAM_SECONDS.labels(api_method, result).observe(time.perf_counter() - t)
+
+
+def run(app):
+    """Serves updates via webhook when WEBHOOK_URL is set, else via polling."""
+    if WEBHOOK_URL:
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
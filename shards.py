@@ -0,0 +1,327 @@
+import asyncio
+import collections
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+import zlib
+
+from broadcast import Broadcaster, BroadcastReport
+
+BROADCAST_SHARDS = int(os.getenv("BROADCAST_SHARDS", "0"))  # broadcast processes (0/1 = in-process)
+# Smaller runs stay in-process. A scheduler tick dispatches roughly
+# subscribers * SCHEDULER_TICK / DELIVERY_WINDOW chats (1/30 of them by default).
+BROADCAST_SHARD_MIN = int(os.getenv("BROADCAST_SHARD_MIN", "200"))
+
+# Shard <-> parent messages over a multiprocessing Pipe:
+#   parent: ("run", run_id, chat_ids)  ("grant",)  ("stop",)
+#   shard:  ("acquire",)  ("pause", seconds)  ("sent", run_id, chat_id, payload)
+#           ("blocked", run_id, chat_id)  ("done", run_id, counts, skipped)  ("error", run_id, text)
+
+
+def shard_of(chat_id, shards):
+    """Stable shard for chat_id (crc32, unlike hash(), is the same in every process)."""
+    return zlib.crc32(str(chat_id).encode()) % shards
+
+
+def partition(chat_ids, shards):
+    parts = [[] for _ in range(shards)]
+    for chat_id in chat_ids:
+        parts[shard_of(chat_id, shards)].append(chat_id)
+    return parts
+
+
+async def _recv(conn):
+    """Awaits the next message on a Pipe end without blocking the loop."""
+    if not conn.poll():
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = conn.fileno()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            loop.remove_reader(fd)
+    return conn.recv()
+
+
+class RemoteBucket:
+    """
+    Global token bucket as seen from a shard: each token is granted by the
+    parent's bucket, so all shards together stay under one rate, and a flood
+    wait hit by any shard pauses every shard. Grants arrive in request order.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._waiters = collections.deque()
+
+    async def acquire(self):
+        ready = asyncio.get_running_loop().create_future()
+        self._waiters.append(ready)
+        self.conn.send(("acquire",))
+        await ready
+
+    def granted(self):
+        ready = self._waiters.popleft()
+        if not ready.done():  # a cancelled waiter's token is simply dropped
+            ready.set_result(None)
+
+    def pause(self, seconds):
+        self.conn.send(("pause", seconds))
+
+
+# ---------- shard process ----------
+
+def _shard_main(index, conn, messages, setup, prepare, token, base_url, parse_mode, log_disable):
+    logging.disable(log_disable)  # same logging.disable() level as the parent
+    try:
+        asyncio.run(_shard_loop(index, conn, messages, setup, prepare, token, base_url, parse_mode))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _shard_loop(index, conn, messages, setup, prepare, token, base_url, parse_mode):
+    from telegram import Bot
+
+    if setup is not None:
+        await setup()
+    bucket = RemoteBucket(conn)
+    runs = set()
+    async with Bot(token, base_url=base_url) as bot:
+        while True:
+            try:
+                msg = await _recv(conn)
+            except EOFError:
+                break  # parent is gone
+            if msg[0] == "grant":
+                bucket.granted()
+            elif msg[0] == "run":
+                task = asyncio.create_task(
+                    _shard_run(index, msg[1], msg[2], conn, bot, bucket, messages, prepare, parse_mode)
+                )
+                runs.add(task)
+                task.add_done_callback(runs.discard)
+            elif msg[0] == "stop":
+                break
+        for task in runs:
+            task.cancel()
+    conn.close()
+
+
+async def _shard_run(index, run_id, chat_ids, conn, bot, bucket, messages, prepare, parse_mode):
+    try:
+        if prepare is not None:
+            await prepare(chat_ids)
+        pending, skipped = {}, []
+
+        # Reported as they happen, so a crash later in the run loses none of them
+        def on_sent(chat_id):
+            conn.send(("sent", run_id, chat_id, pending.pop(str(chat_id), None)))
+
+        def on_blocked(chat_id):
+            conn.send(("blocked", run_id, chat_id))
+
+        report = await Broadcaster(bot, bucket=bucket).run(
+            messages(chat_ids, pending, skipped), parse_mode=parse_mode, on_sent=on_sent, on_blocked=on_blocked
+        )
+        conn.send(("done", run_id, report.as_dict(), skipped))
+    except Exception as e:
+        logging.exception(f"Broadcast shard {index} failed run {run_id}")
+        conn.send(("error", run_id, f"{type(e).__name__}: {e}"))
+
+
+# ---------- parent ----------
+
+class _Shard:
+    __slots__ = ("index", "process", "conn", "reader")
+
+    def __init__(self, index, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.reader = None
+
+    def alive(self):
+        return self.process.is_alive() and self.reader is not None and not self.reader.done()
+
+
+class _Run:
+    """One broadcast across the shards: what each shard has reported so far."""
+
+    __slots__ = ("report", "delivered", "skipped", "parts", "progress", "waiting", "finished")
+
+    def __init__(self, parts):
+        self.report = BroadcastReport()
+        self.delivered = []                                  # [(chat_id, payload)]
+        self.skipped = []
+        self.parts = parts                                   # shard index -> chat_ids
+        self.progress = {index: [0, 0] for index in parts}   # shard index -> [sent, blocked]
+        self.waiting = set(parts)
+        self.finished = asyncio.get_running_loop().create_future()
+
+    def sent(self, index, chat_id, payload):
+        self.progress[index][0] += 1
+        self.delivered.append((chat_id, payload))
+
+    def blocked(self, index, chat_id):
+        self.progress[index][1] += 1
+        self.report.blocked_chats.append(chat_id)
+
+    def done(self, index, counts, skipped):
+        if index not in self.waiting:
+            return
+        self.report.add(counts)
+        self.skipped.extend(skipped)
+        self._settle(index)
+
+    def fail(self, index, reason):
+        """The shard died or errored: keep what it reported, count the rest as failed."""
+        if index not in self.waiting:
+            return
+        sent, blocked = self.progress[index]
+        logging.error(f"Broadcast shard {index} failed ({reason}); "
+                      f"{len(self.parts[index]) - sent - blocked} of {len(self.parts[index])} chats unfinished")
+        self.report.sent += sent
+        self.report.blocked += blocked
+        self.report.failed += len(self.parts[index]) - sent - blocked
+        self._settle(index)
+
+    def _settle(self, index):
+        self.waiting.discard(index)
+        if not self.waiting and not self.finished.done():
+            self.finished.set_result(None)
+
+
+class ShardPool:
+    """
+    Long-lived broadcast processes, started once and reused by every run.
+
+    run() partitions chats with shard_of(); each shard runs
+    `await prepare(chat_ids)` and then sends what the async iterator
+    `messages(chat_ids, pending, skipped)` yields (same contract as
+    Broadcaster.run) with its own Bot, drawing every token from the
+    parent's `bucket`. `setup()` runs once when a shard starts. The three
+    must be module-level functions (they are pickled).
+
+    Shards report each delivered and blocked chat as it happens, so a shard
+    that dies mid-run only fails the chats it hadn't finished; it is
+    respawned for the next run. Overlapping runs share the shards.
+    """
+
+    def __init__(self, shards, messages, *, token, base_url, bucket, setup=None, prepare=None, parse_mode=None):
+        self.shards = shards
+        self.messages = messages
+        self.token = token
+        self.base_url = base_url.replace(token, "{token}")  # Bot() re-inserts it
+        self.bucket = bucket
+        self.setup = setup
+        self.prepare = prepare
+        self.parse_mode = parse_mode
+        self._ctx = multiprocessing.get_context("spawn")  # fork would copy the running loop and open sockets
+        self._shards = {}
+        self._runs = {}
+        self._run_ids = itertools.count(1)
+
+    def start(self):
+        """(Re)spawns shards that aren't running."""
+        for index in range(self.shards):
+            shard = self._shards.get(index)
+            if shard is not None and shard.alive():
+                continue
+            if shard is not None:
+                self._discard(shard)
+            parent_conn, child_conn = self._ctx.Pipe()
+            process = self._ctx.Process(
+                target=_shard_main,
+                args=(index, child_conn, self.messages, self.setup, self.prepare, self.token, self.base_url,
+                      self.parse_mode, logging.root.manager.disable),
+                name=f"broadcast-shard-{index}",
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            shard = self._shards[index] = _Shard(index, process, parent_conn)
+            shard.reader = asyncio.create_task(self._read(shard))
+        return self
+
+    async def run(self, chat_ids):
+        """Returns (report, delivered, skipped) like sharded sends: [(chat_id, payload)] and unchanged chats."""
+        self.start()
+        parts = {index: part for index, part in enumerate(partition(chat_ids, self.shards)) if part}
+        run_id = next(self._run_ids)
+        run = self._runs[run_id] = _Run(parts)
+        try:
+            for index, part in parts.items():
+                try:
+                    self._shards[index].conn.send(("run", run_id, part))
+                except OSError as e:
+                    run.fail(index, f"{type(e).__name__}: {e}")
+            if parts:
+                await run.finished
+        finally:
+            del self._runs[run_id]
+        run.report.duration = time.monotonic() - run.report.started
+        logging.info(f"Sharded broadcast over {len(parts)} processes: {run.report}")
+        return run.report, run.delivered, run.skipped
+
+    async def _read(self, shard):
+        """Routes one shard's messages; grants its token requests in order from the global bucket."""
+        requests = asyncio.Queue()
+        granter = asyncio.create_task(self._grant(shard, requests))
+        try:
+            while True:
+                try:
+                    msg = await _recv(shard.conn)
+                except (EOFError, OSError):
+                    break
+                if msg[0] == "acquire":
+                    requests.put_nowait(None)
+                elif msg[0] == "pause":
+                    self.bucket.pause(msg[1])
+                else:
+                    run = self._runs.get(msg[1])
+                    if run is None:
+                        continue
+                    if msg[0] == "sent":
+                        run.sent(shard.index, msg[2], msg[3])
+                    elif msg[0] == "blocked":
+                        run.blocked(shard.index, msg[2])
+                    elif msg[0] == "done":
+                        run.done(shard.index, msg[2], msg[3])
+                    elif msg[0] == "error":
+                        run.fail(shard.index, msg[2])
+        finally:
+            granter.cancel()
+            for run in self._runs.values():
+                run.fail(shard.index, "process exited")
+
+    async def _grant(self, shard, requests):
+        while True:
+            await requests.get()
+            await self.bucket.acquire()
+            try:
+                shard.conn.send(("grant",))
+            except OSError:
+                return
+
+    def _discard(self, shard):
+        shard.conn.close()
+        if shard.process.is_alive():
+            shard.process.terminate()
+        shard.process.join(0)
+
+    async def close(self, timeout=5.0):
+        loop = asyncio.get_running_loop()
+        for shard in self._shards.values():
+            try:
+                shard.conn.send(("stop",))
+            except OSError:
+                pass
+        for shard in self._shards.values():
+            await loop.run_in_executor(None, shard.process.join, timeout)
+            if shard.reader is not None:
+                shard.reader.cancel()
+            self._discard(shard)
+        self._shards.clear()
@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import os
+import random
+import time
+
+import httpx
+
+import metrics
+
+# Pool / transport settings for Apps Script traffic
+SHEETS_TIMEOUT = float(os.getenv("SHEETS_TIMEOUT", "20"))
+SHEETS_CONNECT_TIMEOUT = float(os.getenv("SHEETS_CONNECT_TIMEOUT", "5"))
+SHEETS_MAX_CONNECTIONS = int(os.getenv("SHEETS_MAX_CONNECTIONS", "20"))
+SHEETS_MAX_KEEPALIVE = int(os.getenv("SHEETS_MAX_KEEPALIVE", "10"))
+SHEETS_KEEPALIVE_EXPIRY = float(os.getenv("SHEETS_KEEPALIVE_EXPIRY", "60"))
+SHEETS_HTTP2 = os.getenv("SHEETS_HTTP2", "0") == "1"
+
+# Failure handling: every call gets a total time budget; idempotent reads are
+# retried with jittered exponential backoff inside it, and the breaker opens
+# after SHEETS_BREAKER_THRESHOLD consecutive failures.
+SHEETS_DEADLINE = float(os.getenv("SHEETS_DEADLINE", "8"))
+SHEETS_RETRIES = int(os.getenv("SHEETS_RETRIES", "2"))
+SHEETS_BACKOFF = float(os.getenv("SHEETS_BACKOFF", "0.3"))
+SHEETS_BREAKER_THRESHOLD = int(os.getenv("SHEETS_BREAKER_THRESHOLD", "5"))
+SHEETS_BREAKER_RESET = float(os.getenv("SHEETS_BREAKER_RESET", "30"))
+
+# Phrases GAS uses when a daily/rate quota is exhausted
+_QUOTA_ERRORS = ("too many times", "quota", "rate limit")
+
+
+class SheetsError(Exception):
+    """Base class for Apps Script failures."""
+
+
+class SheetsTimeout(SheetsError):
+    """The call did not finish within its deadline."""
+
+
+class SheetsQuota(SheetsError):
+    """Apps Script refused the call because a quota is exhausted."""
+
+
+class SheetsPayloadError(SheetsError):
+    """The endpoint answered, but not with JSON."""
+
+
+class SheetsUnavailable(SheetsError):
+    """The circuit breaker is open or the endpoint keeps failing."""
+
+    def __init__(self, message, retry_in=0.0):
+        super().__init__(message)
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure breaker. While open, calls fail immediately instead
+    of waiting out GAS timeouts; after `reset_timeout` one probe call is let
+    through (half-open) and its outcome closes or re-opens the breaker.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, threshold=SHEETS_BREAKER_THRESHOLD, reset_timeout=SHEETS_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and self.retry_in() == 0:
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self.state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def retry_in(self):
+        if self.state == self.CLOSED:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logging.info("Sheets circuit breaker closed")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+            logging.warning(f"Sheets circuit breaker open for {self.reset_timeout:.0f}s after {self.failures} failure(s)")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probing = False
+
+    def record_abandoned(self):
+        """A call ended with no outcome (cancelled, unexpected error): an unfinished probe counts as failed."""
+        if self.state == self.HALF_OPEN and self._probing:
+            self.record_failure()
+
+
+def _http2_available():
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class SheetsClient:
+    """
+    Single long-lived HTTP client for every Apps Script call.
+
+    GAS answers on script.google.com and redirects to
+    script.googleusercontent.com, so keep-alive pooling saves a TCP + TLS
+    handshake on both hops. The client is opened by the Application's
+    post_init hook and closed in post_shutdown.
+
+    get_json()/post_json() are the resilient entry points: deadline budget,
+    retries for idempotent calls, circuit breaker and typed SheetsError
+    subclasses. get()/post() are the raw single-shot requests underneath.
+    """
+
+    def __init__(self, url, timeout=SHEETS_TIMEOUT, max_connections=SHEETS_MAX_CONNECTIONS,
+                 max_keepalive=SHEETS_MAX_KEEPALIVE, keepalive_expiry=SHEETS_KEEPALIVE_EXPIRY,
+                 http2=SHEETS_HTTP2, deadline=SHEETS_DEADLINE, retries=SHEETS_RETRIES,
+                 backoff=SHEETS_BACKOFF, breaker=None):
+        self.url = url
+        self.timeout = timeout
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        if http2 and not _http2_available():
+            logging.warning("SHEETS_HTTP2 requested but 'h2' is not installed; using HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+        self._client = None
+
+    async def start(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                follow_redirects=True,
+                limits=self.limits,
+                http2=self.http2,
+                timeout=httpx.Timeout(self.timeout, connect=SHEETS_CONNECT_TIMEOUT),
+            )
+        return self
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            raise RuntimeError("SheetsClient used before start()")
+        return self._client
+
+    def _timeout(self, timeout):
+        if timeout is None:
+            return httpx.USE_CLIENT_DEFAULT
+        return httpx.Timeout(timeout, connect=min(timeout, SHEETS_CONNECT_TIMEOUT))
+
+    async def get(self, params=None, timeout=None):
+        return await self.client.get(self.url, params=params, timeout=self._timeout(timeout))
+
+    async def post(self, payload, timeout=None):
+        return await self.client.post(self.url, json=payload, timeout=self._timeout(timeout))
+
+    async def get_json(self, params=None, op="get", deadline=None):
+        """Idempotent read: retried within the deadline."""
+        return await self._call(op, lambda t: self.get(params=params, timeout=t), deadline, idempotent=True)
+
+    async def post_json(self, payload, op="post", deadline=None, idempotent=False):
+        """POST; only retried when the caller says repeating it is harmless (e.g. bulk reads)."""
+        return await self._call(op, lambda t: self.post(payload, timeout=t), deadline, idempotent)
+
+    async def _call(self, op, send, deadline, idempotent):
+        budget_end = time.monotonic() + (deadline if deadline is not None else self.deadline)
+        attempts = 1 + (self.retries if idempotent else 0)
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                metrics.SHEETS_SHORT_CIRCUITS.labels(op).inc()
+                retry_in = self.breaker.retry_in()
+                raise SheetsUnavailable(f"Sheets is unavailable, retry in {retry_in:.0f}s", retry_in)
+
+            remaining = budget_end - time.monotonic()
+            t = time.perf_counter()
+            try:
+                result = self._decode(await send(min(self.timeout, remaining)))
+            except SheetsPayloadError:
+                # GAS answered, so the service is up; the payload just isn't usable
+                self.breaker.record_success()
+                metrics.SHEETS_SECONDS.labels(op, "invalid_json").observe(time.perf_counter() - t)
+                raise
+            except SheetsError as e:
+                error = e
+            except httpx.TimeoutException:
+                error = SheetsTimeout(f"Sheets did not answer within {remaining:.1f}s")
+            except httpx.HTTPError as e:
+                error = SheetsUnavailable(f"Sheets request failed: {type(e).__name__} {e}".rstrip())
+            except BaseException:
+                # Otherwise a cancelled probe would leave the breaker half-open for good
+                self.breaker.record_abandoned()
+                raise
+            else:
+                self.breaker.record_success()
+                metrics.SHEETS_SECONDS.labels(op, "success").observe(time.perf_counter() - t)
+                return result
+
+            self.breaker.record_failure()
+            metrics.SHEETS_SECONDS.labels(op, _result_label(error)).observe(time.perf_counter() - t)
+            if isinstance(error, SheetsQuota) or attempt == attempts - 1:
+                raise error
+            delay = self.backoff * (2 ** attempt) * (1 + random.random())
+            # Not worth retrying if the next attempt would have almost no time left
+            if budget_end - time.monotonic() - delay < 0.5:
+                raise error
+            metrics.SHEETS_RETRIES.labels(op).inc()
+            logging.warning(f"Sheets {op} failed ({error}); retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _decode(response):
+        if response.status_code == 429:
+            raise SheetsQuota("Sheets quota exhausted (HTTP 429)")
+        if response.status_code >= 500:
+            raise SheetsUnavailable(f"Sheets answered HTTP {response.status_code}")
+        try:
+            return response.json()
+        except ValueError:
+            # GAS reports failures as HTML pages, quota errors included
+            text = response.text[:500].lower()
+            if any(err in text for err in _QUOTA_ERRORS):
+                raise SheetsQuota("Sheets quota exhausted")
+            raise SheetsPayloadError(f"Sheets returned non-JSON (HTTP {response.status_code})")
+
+
+def _result_label(error):
+    if isinstance(error, SheetsTimeout):
+        return "timeout"
+    if isinstance(error, SheetsQuota):
+        return "quota"
+    return "error"
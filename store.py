@@ -0,0 +1,375 @@
+import collections
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import time
+
+DB_PATH = os.getenv("DB_PATH", "bot.db")
+CAPTCHA_TTL = float(os.getenv("CAPTCHA_TTL", "600"))  # seconds a chat may wait on a CAPTCHA
+
+# Each entry upgrades the schema by one version (tracked in PRAGMA user_version)
+MIGRATIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS subscribers (
+        chat_id    TEXT PRIMARY KEY,
+        enabled    INTEGER NOT NULL DEFAULT 0,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS subscribers_enabled ON subscribers (chat_id) WHERE enabled = 1;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS captcha_waits (
+        chat_id     TEXT PRIMARY KEY,
+        job_id      TEXT,
+        issued_at   REAL NOT NULL,
+        expires_at  REAL NOT NULL,
+        answered_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS captcha_waits_expiry ON captcha_waits (expires_at);
+    """,
+    """
+    ALTER TABLE subscribers ADD COLUMN tz TEXT;
+    ALTER TABLE subscribers ADD COLUMN delivery_time TEXT;
+    ALTER TABLE subscribers ADD COLUMN last_delivered TEXT;
+    """,
+    """
+    ALTER TABLE subscribers ADD COLUMN threshold REAL;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS snapshots (
+        chat_id  TEXT NOT NULL,
+        taken_at REAL NOT NULL,
+        keyframe INTEGER NOT NULL,
+        payload  BLOB NOT NULL,
+        PRIMARY KEY (chat_id, taken_at)
+    ) WITHOUT ROWID;
+    """,
+    """
+    ALTER TABLE subscribers ADD COLUMN alert_mode TEXT;
+    ALTER TABLE subscribers ADD COLUMN sent_hash TEXT;
+    ALTER TABLE subscribers ADD COLUMN sent_snapshot BLOB;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS history_checks (
+        chat_id    TEXT PRIMARY KEY,
+        checked_at REAL NOT NULL
+    ) WITHOUT ROWID;
+    """,
+]
+
+
+def open_db(path=DB_PATH):
+    """Opens the bot's SQLite database in WAL mode and applies pending migrations."""
+    conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for i, script in enumerate(MIGRATIONS[version:], start=version + 1):
+        with conn:
+            conn.execute("BEGIN")
+            for stmt in script.split(";"):
+                if stmt.strip():
+                    conn.execute(stmt)
+            conn.execute(f"PRAGMA user_version={i}")
+    return conn
+
+
+class Subscription:
+    """In-memory copy of one subscribers row."""
+
+    __slots__ = ("chat_id", "enabled", "tz", "delivery_time", "last_delivered", "threshold",
+                 "alert_mode", "sent_hash", "sent_snapshot")
+
+    def __init__(self, chat_id, enabled=False, tz=None, delivery_time=None, last_delivered=None, threshold=None,
+                 alert_mode=None, sent_hash=None, sent_snapshot=None):
+        self.chat_id = chat_id
+        self.enabled = enabled
+        self.tz = tz                          # IANA name, None = bot default
+        self.delivery_time = delivery_time    # "HH:MM", None = bot default
+        self.last_delivered = last_delivered  # local date (ISO) of the last daily summary
+        self.threshold = threshold            # attendance target as a fraction, None = bot default
+        self.alert_mode = alert_mode          # "full" | "changes" | "diff", None = bot default
+        self.sent_hash = sent_hash            # content hash of the data behind the last daily summary
+        self.sent_snapshot = sent_snapshot    # that data, encoded like a history keyframe
+
+
+class SubscriberStore:
+    """
+    Alert subscribers in SQLite with an in-memory read index.
+
+    Reads (is_enabled, counts) never touch disk; each toggle is a single-row
+    upsert in its own transaction, so concurrent toggles can't lose writes
+    and a crash can't leave a half-written file behind.
+    """
+
+    def __init__(self, path=DB_PATH, legacy_json=None):
+        self.path = path
+        self.legacy_json = legacy_json
+        self.conn = None
+        self._subs = {}
+
+    def open(self):
+        if self.conn is not None:
+            return self
+        self.conn = open_db(self.path)
+        for chat_id, enabled, *rest in self.conn.execute(
+            "SELECT chat_id, enabled, tz, delivery_time, last_delivered, threshold, "
+            "alert_mode, sent_hash, sent_snapshot FROM subscribers"
+        ):
+            self._subs[chat_id] = Subscription(chat_id, bool(enabled), *rest)
+        if self.legacy_json and os.path.exists(self.legacy_json):
+            self._migrate_json(self.legacy_json)
+        return self
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _migrate_json(self, path):
+        """One-time import of the old alerts.json ({chat_id: bool}); the file is renamed afterwards."""
+        try:
+            with open(path, "r") as f:
+                legacy = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not read legacy alerts file {path}: {e}")
+            return
+        now = time.time()
+        rows = [(str(chat_id), int(bool(enabled)), now) for chat_id, enabled in legacy.items()]
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO subscribers (chat_id, enabled, updated_at) VALUES (?, ?, ?)", rows
+            )
+        for chat_id, enabled, _ in rows:
+            self._subs.setdefault(chat_id, Subscription(chat_id, bool(enabled)))
+        os.replace(path, path + ".migrated")
+        logging.info(f"Migrated {len(rows)} subscribers from {path}")
+
+    # ---------- reads (in-memory) ----------
+
+    def get(self, chat_id):
+        return self._subs.get(str(chat_id))
+
+    def is_enabled(self, chat_id):
+        sub = self._subs.get(str(chat_id))
+        return sub is not None and sub.enabled
+
+    def count_enabled(self):
+        return sum(1 for sub in self._subs.values() if sub.enabled)
+
+    def enabled_subscriptions(self):
+        """Snapshot of enabled subscriptions from memory (for the delivery scheduler)."""
+        return [sub for sub in self._subs.values() if sub.enabled]
+
+    def iter_enabled(self, page_size=500):
+        """Streams enabled chat_ids from disk a page at a time (keyset pagination)."""
+        last = ""
+        while True:
+            page = self.conn.execute(
+                "SELECT chat_id FROM subscribers WHERE enabled = 1 AND chat_id > ? ORDER BY chat_id LIMIT ?",
+                (last, page_size),
+            ).fetchall()
+            if not page:
+                return
+            for (chat_id,) in page:
+                yield chat_id
+            last = page[-1][0]
+
+    def reload(self, chat_ids, chunk=500):
+        """Re-reads these chats from disk (a broadcast shard's copy goes stale between runs)."""
+        chat_ids = [str(c) for c in chat_ids]
+        for i in range(0, len(chat_ids), chunk):
+            page = chat_ids[i:i + chunk]
+            for chat_id in page:
+                self._subs.pop(chat_id, None)
+            for chat_id, enabled, *rest in self.conn.execute(
+                "SELECT chat_id, enabled, tz, delivery_time, last_delivered, threshold, alert_mode, sent_hash, "
+                f"sent_snapshot FROM subscribers WHERE chat_id IN ({', '.join('?' for _ in page)})",
+                page,
+            ):
+                self._subs[chat_id] = Subscription(chat_id, bool(enabled), *rest)
+
+    # ---------- writes ----------
+
+    def _update(self, chat_id, **fields):
+        """Upserts one chat's columns in a single statement and mirrors them in memory."""
+        chat_id = str(chat_id)
+        columns = ", ".join(fields)
+        marks = ", ".join("?" for _ in fields)
+        updates = ", ".join(f"{c} = excluded.{c}" for c in fields)
+        with self.conn:
+            self.conn.execute(
+                f"INSERT INTO subscribers (chat_id, {columns}, updated_at) VALUES (?, {marks}, ?) "
+                f"ON CONFLICT (chat_id) DO UPDATE SET {updates}, updated_at = excluded.updated_at",
+                (chat_id, *fields.values(), time.time()),
+            )
+        sub = self._subs.get(chat_id)
+        if sub is None:
+            sub = self._subs[chat_id] = Subscription(chat_id)
+        for name, value in fields.items():
+            setattr(sub, name, value)
+        return sub
+
+    def set_enabled(self, chat_id, enabled):
+        self._update(chat_id, enabled=bool(enabled))
+
+    def set_schedule(self, chat_id, tz=None, delivery_time=None):
+        fields = {}
+        if tz is not None:
+            fields["tz"] = tz
+        if delivery_time is not None:
+            fields["delivery_time"] = delivery_time
+        if fields:
+            self._update(chat_id, **fields)
+
+    def set_threshold(self, chat_id, threshold):
+        """Stores the chat's default attendance target (a fraction); None restores the bot default."""
+        self._update(chat_id, threshold=None if threshold is None else float(threshold))
+
+    def set_alert_mode(self, chat_id, mode):
+        self._update(chat_id, alert_mode=mode)
+
+    def mark_sent(self, sent):
+        """`sent` is [(chat_id, content_hash, snapshot)] for summaries that went out; one transaction."""
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "UPDATE subscribers SET sent_hash = ?, sent_snapshot = ? WHERE chat_id = ?",
+                [(content_hash, snapshot, str(chat_id)) for chat_id, content_hash, snapshot in sent],
+            )
+        for chat_id, content_hash, snapshot in sent:
+            sub = self._subs.get(str(chat_id))
+            if sub is not None:
+                sub.sent_hash = content_hash
+                sub.sent_snapshot = snapshot
+
+    def mark_delivered(self, deliveries):
+        """`deliveries` is [(chat_id, local_date)]; recorded in one transaction."""
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "UPDATE subscribers SET last_delivered = ? WHERE chat_id = ?",
+                [(day, str(chat_id)) for chat_id, day in deliveries],
+            )
+        for chat_id, day in deliveries:
+            sub = self._subs.get(str(chat_id))
+            if sub is not None:
+                sub.last_delivered = day
+
+    def remove(self, chat_ids):
+        chat_ids = [str(c) for c in chat_ids]
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany("DELETE FROM subscribers WHERE chat_id = ?", [(c,) for c in chat_ids])
+        for chat_id in chat_ids:
+            self._subs.pop(chat_id, None)
+
+
+class CaptchaWaits:
+    """
+    Chats waiting to answer a CAPTCHA, persisted so a restart doesn't drop them.
+
+    Entries expire after `ttl` seconds; sweep() removes them (memory via a
+    heap, disk via the expires_at index). Issue and answer times are kept
+    so CAPTCHA round-trip latency can be measured.
+    """
+
+    def __init__(self, path=DB_PATH, ttl=CAPTCHA_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.conn = None
+        self._waits = {}     # chat_id -> [job_id, issued_at, expires_at, answered_at]
+        self._expiry = []    # heap of (expires_at, chat_id); stale entries skipped lazily
+        self.latencies = collections.deque(maxlen=500)
+        self.expired = 0
+
+    def open(self):
+        if self.conn is not None:
+            return self
+        self.conn = open_db(self.path)
+        now = time.time()
+        self.conn.execute("DELETE FROM captcha_waits WHERE expires_at <= ?", (now,))
+        for chat_id, job_id, issued_at, expires_at, answered_at in self.conn.execute(
+            "SELECT chat_id, job_id, issued_at, expires_at, answered_at FROM captcha_waits"
+        ):
+            self._waits[chat_id] = [job_id, issued_at, expires_at, answered_at]
+            heapq.heappush(self._expiry, (expires_at, chat_id))
+        if self._waits:
+            logging.info(f"Restored {len(self._waits)} pending CAPTCHA waits")
+        return self
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def __contains__(self, chat_id):
+        entry = self._waits.get(str(chat_id))
+        return entry is not None and entry[2] > time.time()
+
+    def add(self, chat_id, job_id=None):
+        chat_id = str(chat_id)
+        now = time.time()
+        expires_at = now + self.ttl
+        self._waits[chat_id] = [job_id, now, expires_at, None]
+        heapq.heappush(self._expiry, (expires_at, chat_id))
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO captcha_waits (chat_id, job_id, issued_at, expires_at, answered_at) "
+                "VALUES (?, ?, ?, ?, NULL)",
+                (chat_id, job_id, now, expires_at),
+            )
+
+    def job_id(self, chat_id):
+        entry = self._waits.get(str(chat_id))
+        return entry[0] if entry else None
+
+    def answered(self, chat_id):
+        """Records the first answer to the current CAPTCHA; returns its latency in seconds or None."""
+        entry = self._waits.get(str(chat_id))
+        if entry is None or entry[3] is not None:
+            return None
+        entry[3] = time.time()
+        latency = entry[3] - entry[1]
+        self.latencies.append(latency)
+        with self.conn:
+            self.conn.execute("UPDATE captcha_waits SET answered_at = ? WHERE chat_id = ?", (entry[3], str(chat_id)))
+        return latency
+
+    def discard(self, chat_id):
+        if self._waits.pop(str(chat_id), None) is not None:
+            with self.conn:
+                self.conn.execute("DELETE FROM captcha_waits WHERE chat_id = ?", (str(chat_id),))
+
+    def sweep(self):
+        """Drops expired waits; returns the chat_ids that expired."""
+        now = time.time()
+        expired = []
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, chat_id = heapq.heappop(self._expiry)
+            entry = self._waits.get(chat_id)
+            if entry is not None and entry[2] == expires_at:
+                del self._waits[chat_id]
+                expired.append(chat_id)
+        if expired:
+            self.expired += len(expired)
+            with self.conn:
+                self.conn.execute("DELETE FROM captcha_waits WHERE expires_at <= ?", (now,))
+        return expired
+
+    def stats(self):
+        ordered = sorted(self.latencies)
+
+        def quantile(q):
+            return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+        return {
+            "waiting": len(self._waits),
+            "expired": self.expired,
+            "answered": len(ordered),
+            "latency_p50": quantile(0.5),
+            "latency_p95": quantile(0.95),
+        }
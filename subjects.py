@@ -0,0 +1,156 @@
+import re
+
+_NON_ALNUM = re.compile(r"[^0-9a-z]+")
+
+# Match scores, best first
+EXACT, INITIALS, SUBSTRING, TOKENS, FUZZY = 100, 90, 80, 60, 30
+
+
+def normalize(text):
+    return _NON_ALNUM.sub(" ", text.lower()).strip()
+
+
+def get_initials(name):
+    # "Business Economics" -> "BE"
+    parts = name.split()
+    return "".join(p[0].upper() for p in parts if p)
+
+
+def edit_distance(a, b, limit):
+    """Damerau-Levenshtein (optimal string alignment) distance, or limit + 1 once it exceeds limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        if min(cur) > limit:
+            return limit + 1
+        prev2, prev = prev, cur
+    return prev[-1]
+
+
+def _fuzzy_limit(token):
+    # "pyhton" -> 1 edit; very short tokens must match exactly
+    if len(token) < 4:
+        return 0
+    return 1 if len(token) < 8 else 2
+
+
+class SubjectIndex:
+    """
+    Lookup structure over one chat's rows, built once per fetched dataset.
+
+    A query matches a subject by (best first): exact name, full initials
+    ("BE"), substring of the name, or token-wise where every query token is
+    a prefix of a subject word or the initials of consecutive words
+    ("BE lab" -> "Business Economics Lab"). When nothing matches, tokens
+    are retried with a small edit-distance budget ("pyhton").
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.names = [normalize(r.subject) for r in rows]
+        self.initials = [get_initials(n).lower() for n in self.names]
+        self.prefixes = {}   # word prefix -> {row index}
+        self.spans = {}      # initials of consecutive words -> {row index}
+        self.vocab = set()
+
+        for i, name in enumerate(self.names):
+            words = name.split()
+            for w in words:
+                self.vocab.add(w)
+                for k in range(1, len(w) + 1):
+                    self.prefixes.setdefault(w[:k], set()).add(i)
+            for start in range(len(words)):
+                acc = ""
+                for w in words[start:]:
+                    acc += w[0]
+                    if len(acc) > 1:
+                        self.spans.setdefault(acc, set()).add(i)
+
+    def _fuzzy_keys(self):
+        for word in self.vocab:
+            yield word, self.prefixes[word], True
+        # initials too, so "dbms" still finds "Database Management Systems" ("dms")
+        for key, rows in self.spans.items():
+            yield key, rows, False
+
+    def _token_rows(self, token):
+        return self.prefixes.get(token, set()) | self.spans.get(token, set())
+
+    def _fuzzy_rows(self, token):
+        limit = _fuzzy_limit(token)
+        if not limit:
+            return set(), 0
+        best, found = limit + 1, set()
+        for key, rows, is_word in self._fuzzy_keys():
+            d = edit_distance(token, key, limit)
+            if is_word and len(key) > len(token):
+                # also allow typos in a prefix ("progrm" vs "programming")
+                d = min(d, edit_distance(token, key[:len(token)], limit))
+            if d < best:
+                best, found = d, set(rows)
+            elif d == best:
+                found |= rows
+        return (found, best) if best <= limit else (set(), 0)
+
+    def search(self, query):
+        """Returns matching rows, best match first (ties keep sheet order)."""
+        q = normalize(query)
+        if not q:
+            return []
+        tokens = q.split()
+        scores = {}
+
+        def score(i, value):
+            if value > scores.get(i, 0):
+                scores[i] = value
+
+        compact = q.replace(" ", "")
+        for i, name in enumerate(self.names):
+            if name == q:
+                score(i, EXACT)
+            elif self.initials[i] == compact:
+                score(i, INITIALS)
+            elif q in name:
+                score(i, SUBSTRING)
+
+        hits = None
+        for t in tokens:
+            rows = self._token_rows(t)
+            hits = rows if hits is None else hits & rows
+        for i in hits or ():
+            # prefer subjects where the query covers more of the name
+            score(i, TOKENS + 10 * len(tokens) // max(1, len(self.names[i].split())))
+
+        if not scores:
+            hits, penalty = None, 0
+            for t in tokens:
+                rows = self._token_rows(t)
+                if not rows:
+                    rows, d = self._fuzzy_rows(t)
+                    penalty += d
+                hits = rows if hits is None else hits & rows
+            for i in hits or ():
+                score(i, FUZZY - penalty)
+
+        ranked = sorted(scores, key=lambda i: (-scores[i], i))
+        return [(self.rows[i], scores[i]) for i in ranked]
+
+    def lookup(self, query):
+        """
+        Returns (best, candidates): `best` is the single winning row or None;
+        `candidates` are all rows sharing the top score (for disambiguation).
+        """
+        results = self.search(query)
+        if not results:
+            return None, []
+        top = results[0][1]
+        candidates = [r for r, s in results if s == top]
+        return (candidates[0] if len(candidates) == 1 else None), candidates
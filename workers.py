@@ -0,0 +1,121 @@
+import logging
+import os
+import time
+
+WORKER_HEARTBEAT_TIMEOUT = float(os.getenv("WORKER_HEARTBEAT_TIMEOUT", "90"))  # silent this long = gone
+WORKER_CAPACITY = int(os.getenv("WORKER_CAPACITY", "1"))  # concurrent scrapes when HELLO doesn't say
+
+
+class Worker:
+    __slots__ = ("worker_id", "capacity", "jobs", "last_seen", "last_assigned", "healthy")
+
+    def __init__(self, worker_id, capacity=WORKER_CAPACITY):
+        self.worker_id = worker_id
+        self.capacity = capacity
+        self.jobs = set()           # job_ids assigned to this worker
+        self.last_seen = time.monotonic()
+        self.last_assigned = 0.0
+        self.healthy = True
+
+    @property
+    def load(self):
+        return len(self.jobs) / self.capacity if self.capacity else float("inf")
+
+    def has_room(self):
+        return self.healthy and len(self.jobs) < self.capacity
+
+
+class WorkerPool:
+    """
+    Worker bots that announced themselves (HELLO) and keep sending HEARTBEATs.
+
+    pick() returns the least-loaded healthy worker with a free slot (ties go
+    to the one that has waited longest for work). sweep() marks workers that
+    went silent as unhealthy and hands back their jobs for reassignment.
+    An empty pool means no worker speaks the pool protocol; the tracker then
+    falls back to unaddressed requests for a single legacy worker.
+    """
+
+    def __init__(self, heartbeat_timeout=WORKER_HEARTBEAT_TIMEOUT):
+        self.heartbeat_timeout = heartbeat_timeout
+        self.workers = {}
+
+    def __len__(self):
+        return len(self.workers)
+
+    def announce(self, worker_id, capacity=None):
+        """
+        HELLO: registers or revives a worker. Returns job_ids it held before,
+        which a (re)starting worker has lost and must be reassigned.
+        """
+        worker = self.workers.get(worker_id)
+        orphaned = []
+        if worker is None:
+            worker = self.workers[worker_id] = Worker(worker_id)
+            logging.info(f"Worker {worker_id} joined")
+        else:
+            orphaned = list(worker.jobs)
+            worker.jobs.clear()
+            if not worker.healthy:
+                logging.info(f"Worker {worker_id} is back")
+        if capacity is not None:
+            worker.capacity = capacity
+        worker.healthy = True
+        worker.last_seen = time.monotonic()
+        return orphaned
+
+    def heartbeat(self, worker_id, capacity=None):
+        worker = self.workers.get(worker_id)
+        if worker is None or not worker.healthy:
+            # We restarted, or it came back after being written off
+            return self.announce(worker_id, capacity)
+        if capacity is not None:
+            worker.capacity = capacity
+        worker.last_seen = time.monotonic()
+        return []
+
+    def touch(self, worker_id):
+        """Any reply from a worker counts as a heartbeat."""
+        worker = self.workers.get(worker_id)
+        if worker is not None and worker.healthy:
+            worker.last_seen = time.monotonic()
+
+    def pick(self):
+        candidates = [w for w in self.workers.values() if w.has_room()]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda w: (w.load, w.last_assigned))
+
+    def assign(self, worker, job_id):
+        worker.jobs.add(job_id)
+        worker.last_assigned = time.monotonic()
+
+    def release(self, worker_id, job_id):
+        worker = self.workers.get(worker_id)
+        if worker is not None:
+            worker.jobs.discard(job_id)
+
+    def sweep(self):
+        """Marks silent workers unhealthy; returns the job_ids they were holding."""
+        now = time.monotonic()
+        orphaned = []
+        for worker in self.workers.values():
+            if worker.healthy and now - worker.last_seen > self.heartbeat_timeout:
+                logging.warning(f"Worker {worker.worker_id} silent for {now - worker.last_seen:.0f}s; "
+                                f"reassigning {len(worker.jobs)} job(s)")
+                worker.healthy = False
+                orphaned.extend(worker.jobs)
+                worker.jobs.clear()
+        return orphaned
+
+    def capacity(self):
+        return sum(w.capacity for w in self.workers.values() if w.healthy)
+
+    def stats(self):
+        healthy = [w for w in self.workers.values() if w.healthy]
+        return {
+            "workers": len(healthy),
+            "down": len(self.workers) - len(healthy),
+            "busy_slots": sum(len(w.jobs) for w in healthy),
+            "slots": sum(w.capacity for w in healthy),
+        }